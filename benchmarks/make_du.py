@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# make_du.py
+#
+# Generate synthetic du output to benchmark dircloud with trees of any
+# size, from a few thousand lines to tens of millions.
+#
+# Released under GPLv3 or later
+
+from __future__ import print_function, division
+
+import sys
+import io
+import random
+import argparse
+import time
+
+
+plain_names = ['src', 'lib', 'doc', 'data', 'backup', 'old', 'tmp', 'build',
+               'photos', 'music', 'projects', 'logs', 'cache', 'share']
+unicode_names = [u'Fotografías', u'Música', u'données', u'Ñandú', u'Åsa',
+                 u'документы', u'日本語', u'Überweisungen', u'çà et là']
+
+
+def make_name(n, unicode_ratio):
+    '''Return a directory name, mixing plain words, version-like
+    numbers (to exercise --version_sort) and non-ASCII names'''
+    choice = random.random()
+    if choice < unicode_ratio:
+        name = random.choice(unicode_names)
+    elif choice < 0.5:
+        name = random.choice(plain_names)
+    elif choice < 0.75:
+        name = '%s-%d.%d' % (random.choice(plain_names), random.randint(0, 3),
+                             random.randint(0, 20))
+    else:
+        name = str(random.randint(1, 100000))
+    return '%s_%d' % (name, n)
+
+
+def make_du(out, lines, depth, fanout, skew, unicode_ratio, timestamps):
+    '''Write du-like output to out, in du order (children before their
+    parents, sizes including the children ones), until about lines
+    lines are written.
+
+    The number of subdirectories of each directory follows a Pareto
+    distribution, so most directories are narrow and a few of them are
+    very wide, like in real disks.
+    '''
+    now = time.time()
+    written = [0]
+
+    def write(path, size, mtime):
+        if timestamps:
+            stamp = time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime))
+            line = u'%d\t%s\t%s\n' % (size, stamp, path)
+        else:
+            line = u'%d\t%s\n' % (size, path)
+        out.write(line)
+        written[0] += 1
+
+    def walk(path, level):
+        size = random.randint(1, 64)
+        mtime = now - random.random() * 5 * 365 * 24 * 3600
+        if level < depth:
+            # Pareto values minus one average 1 / (skew - 1)
+            width = int(fanout * (skew - 1) * (random.paretovariate(skew) - 1))
+            for n in range(width):
+                if written[0] >= lines:
+                    break
+                (child_size, child_mtime) = walk('%s/%s' % (path, make_name(n, unicode_ratio)),
+                                                 level + 1)
+                size += child_size
+                mtime = max(mtime, child_mtime)
+        write(path, size, mtime)
+        return (size, mtime)
+
+    # Keep adding top level directories until we reach the requested
+    # size, to avoid ending up with a tiny tree when the random widths
+    # happen to be small near the root
+    size = 0
+    mtime = 0
+    n = 0
+    while written[0] < lines - 1:
+        (child_size, child_mtime) = walk('/data/%s' % (make_name(n, unicode_ratio)), 2)
+        size += child_size
+        mtime = max(mtime, child_mtime)
+        n += 1
+    write('/data', size, mtime)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate synthetic du output for benchmarking dircloud')
+    parser.add_argument('--lines',
+                        type=int,
+                        default=10000,
+                        help='approximate number of lines (default 10000)')
+    parser.add_argument('--depth',
+                        type=int,
+                        default=8,
+                        help='maximum depth of the tree (default 8)')
+    parser.add_argument('--fanout',
+                        type=float,
+                        default=6,
+                        help='scale of the number of subdirectories per directory (default 6)')
+    parser.add_argument('--skew',
+                        type=float,
+                        default=1.2,
+                        help='Pareto shape of directory widths; smaller means wider outliers (default 1.2)')
+    parser.add_argument('--unicode',
+                        type=float,
+                        default=0.1,
+                        help='ratio of non-ASCII names (default 0.1)')
+    parser.add_argument('--time',
+                        action='store_true',
+                        default=False,
+                        help='add a timestamp column, like du --time')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='random seed, for reproducible outputs (default 0)')
+    parser.add_argument('--output',
+                        default='-',
+                        help='output file (default stdout)')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    if args.output == '-':
+        out = sys.stdout
+    else:
+        out = io.open(args.output, 'w', encoding='utf-8')
+    make_du(out, args.lines, args.depth, args.fanout, args.skew,
+            args.unicode, args.time)
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
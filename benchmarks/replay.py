@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# replay.py
+#
+# Replay a list of recorded URLs (an Apache access log or a plain list
+# of paths) against the dircloud WSGI application, in process and
+# concurrently, and report throughput and latency per kind of page.
+#
+# Released under GPLv3 or later
+
+from __future__ import print_function, division
+
+import sys
+import os
+import re
+import io
+import time
+import json
+import threading
+import argparse
+from wsgiref.util import setup_testing_defaults
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bottle
+import dircloud
+
+
+# Apache common and combined log formats: ... "GET /path HTTP/1.1" ...
+request_re = re.compile(r'"GET (\S+) HTTP/[0-9.]+"')
+
+
+def read_urls(filename):
+    '''Return the GET urls of an Apache access log, or the lines of a
+    plain list of urls'''
+    urls = []
+    f = io.open(filename, encoding='utf-8', errors='surrogateescape')
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        match = request_re.search(line)
+        if match:
+            urls.append(match.group(1))
+        elif line.startswith('/'):
+            urls.append(line.split()[0])
+    f.close()
+    return urls
+
+
+def classify(url):
+    '''Return the kind of page of a dircloud url'''
+    (path, query) = (url.split('?', 1) + [''])[:2]
+    if path == '/search':
+        return 'search'
+    if 'dircloud=' in query:
+        return 'statistics'
+    if path.endswith(dircloud.read_from_disk):
+        return 'read_from_disk'
+    if path in ('/metrics', '/robots.txt', '/favicon.ico'):
+        return 'other'
+    return 'directory'
+
+
+def request(app, url):
+    '''Run a GET request through the WSGI application and return the
+    status code and the elapsed seconds'''
+    (path, query) = (url.split('?', 1) + [''])[:2]
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        # WSGI wants latin-1 decoded bytes in PATH_INFO
+        'PATH_INFO': unquote(path).encode('utf-8', 'surrogateescape').decode('latin-1'),
+        'QUERY_STRING': query,
+        }
+    setup_testing_defaults(environ)
+    status = []
+
+    def start_response(status_line, headers, exc_info=None):
+        status.append(status_line)
+
+    start = time.time()
+    try:
+        body = app(environ, start_response)
+        for chunk in body:
+            pass
+        if hasattr(body, 'close'):
+            body.close()
+    except Exception as e:
+        status.append('500 %s' % (e))
+    elapsed = time.time() - start
+    return (int(status[0].split()[0]), elapsed)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def replay(app, urls, concurrency):
+    '''Replay urls against app with concurrency threads.  Return the
+    wall time and a dict of (status, elapsed) lists per kind of page'''
+    results = {}
+    lock = threading.Lock()
+
+    def run(url):
+        (status, elapsed) = request(app, url)
+        with lock:
+            results.setdefault(classify(url), []).append((status, elapsed))
+
+    start = time.time()
+    if concurrency > 1 and ThreadPoolExecutor:
+        pool = ThreadPoolExecutor(max_workers=concurrency)
+        list(pool.map(run, urls))
+        pool.shutdown()
+    else:
+        for url in urls:
+            run(url)
+    return (time.time() - start, results)
+
+
+def report(wall, results):
+    summary = {'wall_seconds': wall, 'kinds': {}}
+    total = sum([len(values) for values in results.values()])
+    summary['requests'] = total
+    summary['throughput'] = total / wall if wall else 0
+    for kind in sorted(results):
+        elapsed = [value[1] for value in results[kind]]
+        errors = len([value for value in results[kind] if value[0] >= 500])
+        summary['kinds'][kind] = {
+            'requests': len(elapsed),
+            'errors': errors,
+            'p50': percentile(elapsed, 50),
+            'p95': percentile(elapsed, 95),
+            'p99': percentile(elapsed, 99),
+            'max': max(elapsed),
+            }
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded urls against dircloud, in process',
+                                     epilog='dircloud options, including the du file(s), go after --')
+    parser.add_argument('urls',
+                        help='Apache access log or list of urls, one per line')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=10,
+                        help='concurrent requests (default 10)')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=1,
+                        help='times to replay the whole list (default 1)')
+    parser.add_argument('--output',
+                        default='',
+                        help='JSON file to record the results (default stdout)')
+    if argv is None:
+        argv = sys.argv[1:]
+    if '--' in argv:
+        dircloud_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    else:
+        dircloud_args = []
+    args = parser.parse_args(argv)
+
+    dircloud.configure(dircloud_args)
+    app = bottle.default_app()
+    urls = read_urls(args.urls) * args.repeat
+
+    # Load the tree first, so the first requests do not pay for it
+    dircloud.read_du_file_maybe(dircloud.args.filename)
+
+    (wall, results) = replay(app, urls, args.concurrency)
+    summary = report(wall, results)
+    summary['dircloud_args'] = dircloud_args
+    summary['concurrency'] = args.concurrency
+
+    print('%d requests in %.2f s, %.1f requests/s' % (summary['requests'], wall,
+                                                     summary['throughput']),
+          file=sys.stderr)
+    print('%-16s %8s %6s %9s %9s %9s' % ('kind', 'requests', 'errors', 'p50', 'p95', 'p99'),
+          file=sys.stderr)
+    for kind in sorted(summary['kinds']):
+        values = summary['kinds'][kind]
+        print('%-16s %8d %6d %9.4f %9.4f %9.4f' % (kind, values['requests'], values['errors'],
+                                                   values['p50'], values['p95'], values['p99']),
+              file=sys.stderr)
+
+    out = json.dumps(summary, indent=1, sort_keys=True)
+    if args.output:
+        f = open(args.output, 'w')
+        f.write(out + '\n')
+        f.close()
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    main()
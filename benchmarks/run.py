@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# run.py
+#
+# Time the hot paths of dircloud on a du file (see make_du.py) and
+# record the results as JSON, to compare them between versions.
+#
+# Released under GPLv3 or later
+
+from __future__ import print_function, division
+
+import sys
+import os
+import json
+import time
+import platform
+import subprocess
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dircloud
+
+
+def timeit(function, repeat):
+    '''Run function repeat times and return its timings in seconds'''
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+    return timings
+
+
+def summary(timings):
+    timings = sorted(timings)
+    return {'min': timings[0],
+            'median': timings[len(timings) // 2],
+            'max': timings[-1],
+            'repeat': len(timings),
+            }
+
+
+def load(du_file):
+    # Force a fresh parse, even if the file was already loaded
+    dircloud.du = dircloud.Tree()
+    return dircloud.read_du_file_maybe([du_file])
+
+
+def run_benchmarks(du_file, repeat):
+    results = {}
+
+    results['read_du_file_maybe'] = summary(timeit(lambda: load(du_file), repeat))
+    tree = load(du_file)
+
+    # iterBranches, as with --tree_db the branches are not in memory
+    widest = max(tree.iterBranches(), key=lambda branch: len(branch[1]))[0]
+    children = tree.getChildren(widest)
+    sample = [widest + child[0] for child in children[:1000]]
+
+    results['getChildren_root'] = summary(timeit(lambda: tree.getChildren('/'), repeat * 100))
+    results['getChildren_widest'] = summary(timeit(lambda: tree.getChildren(widest), repeat * 10))
+    results['getBranch_widest_1000'] = summary(timeit(
+        lambda: [tree.getBranch(name) for name in sample], repeat))
+    results['getBranchNames'] = summary(timeit(tree.getBranchNames, repeat))
+    results['make_cloud_widest'] = summary(timeit(
+        lambda: dircloud.make_cloud(widest, children), repeat))
+    results['search_string'] = summary(timeit(
+        lambda: dircloud.search_results('data', None), repeat))
+    results['search_string_normalized'] = summary(timeit(
+        lambda: dircloud.search_results('donnees', 'on'), repeat))
+
+    info = {
+        'du_file': du_file,
+        'branches': len(tree),
+        'widest': widest,
+        'widest_children': len(children),
+        }
+    return (info, results)
+
+
+def git_version():
+    try:
+        out = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def compare(results, previous):
+    '''Print the median ratio of each benchmark against a previous run'''
+    for name in sorted(results):
+        if name in previous['results']:
+            before = previous['results'][name]['median']
+            after = results[name]['median']
+            ratio = after / before if before else float('inf')
+            print('%-28s %10.6f %10.6f %7.2fx' % (name, before, after, ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark dircloud hot paths on a du file')
+    parser.add_argument('du_file',
+                        help='du output to load (see make_du.py)')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='runs of each benchmark (default 3)')
+    parser.add_argument('--output',
+                        default='',
+                        help='JSON file to record the results (default stdout)')
+    parser.add_argument('--compare',
+                        default='',
+                        help='JSON file of a previous run to compare against')
+    parser.epilog = 'Extra dircloud options, like --pack_tree, can be given after --'
+    if argv is None:
+        argv = sys.argv[1:]
+    if '--' in argv:
+        dircloud_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    else:
+        dircloud_args = []
+    args = parser.parse_args(argv)
+
+    dircloud.configure(['--search_client', 'string'] + dircloud_args + [args.du_file])
+
+    (info, results) = run_benchmarks(args.du_file, args.repeat)
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'dircloud_args': dircloud_args,
+        'info': info,
+        'results': results,
+        }
+
+    out = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        f = open(args.output, 'w')
+        f.write(out + '\n')
+        f.close()
+    else:
+        print(out)
+
+    if args.compare:
+        f = open(args.compare)
+        previous = json.load(f)
+        f.close()
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,13 +17,607 @@ import re
 import fnmatch
 import locale
 import unicodedata
+import stat
+import signal
+import threading
+import gc
+import io
+import json
+import hashlib
+import multiprocessing
+import tempfile
+import hmac
+import weakref
+import cProfile
+import pstats
+import functools
+import itertools
+import types
+import bisect
+import heapq
+import zlib
+import contextlib
 import argparse
-from bottle import route, run, debug, redirect, request, response, static_file
+from array import array
+from collections import OrderedDict
+from wsgiref.simple_server import WSGIServer
+import bottle
+from bottle import hook, route, run, debug, redirect, request, response, static_file, HTTPResponse, html_escape
 
 if sys.version_info[0] == 2:
     import commands as subprocess
+    # No surrogateescape: undecodable bytes become U+FFFD
+    name_errors = 'replace'
 else:
     import subprocess
+    # Names not valid in UTF-8 are kept as they are, see displayable()
+    name_errors = 'surrogateescape'
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5: fall back to listdir and a single stat per entry
+    scandir = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+try:
+    import asyncio
+except ImportError:
+    # Python 2: no --server asyncio
+    asyncio = None
+
+try:
+    import numpy
+except ImportError:
+    # Type statistics fall back to plain Python loops
+    numpy = None
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    '''wsgiref server that handles each request in its own thread'''
+    daemon_threads = True
+
+
+class AsyncioServer(bottle.ServerAdapter):
+    '''Bottle server adapter serving the application from an asyncio
+    event loop (--server asyncio).
+
+    Directory pages of the in-memory tree, that never wait for disks
+    nor backends (see inline_request), are answered right away on the
+    loop.  The other requests run in a pool of --async_workers
+    threads, and get a 504 if they are not done after
+    --backend_timeout seconds; the commands they run, like locate, are
+    run and read by the loop (see run_command).  Idle and slow clients
+    only cost a socket, not a thread.
+    '''
+
+    keepalive = 15
+
+    def run(self, handler):
+        global async_server
+        self.handler = handler
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.thread = threading.current_thread()
+        self.pool = ThreadPoolExecutor(max_workers=args.async_workers)
+        server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: AsyncioHTTPProtocol(self),
+                                    self.host, self.port))
+        async_server = self
+        try:
+            self.loop.run_forever()
+        finally:
+            async_server = None
+            server.close()
+            self.pool.shutdown(wait=False)
+            self.loop.close()
+
+    def environ(self, head, transport):
+        '''Return the WSGI environ of a request head, or None if it
+        cannot be parsed'''
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            (method, target, protocol) = lines[0].split(' ')
+        except ValueError:
+            return None
+        (path, query) = (target.split('?', 1) + [''])[:2]
+        peer = transport.get_extra_info('peername') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': bottle.urlunquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': peer[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            }
+        for line in lines[1:]:
+            if not ':' in line:
+                return None
+            (name, value) = line.split(':', 1)
+            name = name.strip().upper().replace('-', '_')
+            value = value.strip()
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            elif 'HTTP_' + name in environ:
+                environ['HTTP_' + name] += ',' + value
+            else:
+                environ['HTTP_' + name] = value
+        return environ
+
+    def call(self, environ, stream=None):
+        '''Run the application and return its status, headers and
+        whole body.
+
+        With stream, the (begin, write, finish) callbacks of handle(),
+        bodies that are not lists, like the pages of wide directories,
+        are sent chunk by chunk as they are rendered instead, and None
+        is returned.  This runs in the pool, so the callbacks are
+        passed to the loop.'''
+        answer = []
+
+        def start_response(status, headers, exc_info=None):
+            answer[:] = [status, headers]
+
+        body = self.handler(environ, start_response)
+        try:
+            if stream is None or isinstance(body, (list, tuple)):
+                return (answer[0], list(answer[1]), [chunk for chunk in body])
+            (begin, write, finish) = stream
+            protocol = begin.protocol
+            started = False
+            try:
+                for chunk in body:
+                    if not started:
+                        self.loop.call_soon_threadsafe(begin, answer[0], list(answer[1]))
+                        started = True
+                    # Do not render faster than the client reads
+                    protocol.writable.wait()
+                    if protocol.transport is None or begin.cancelled.is_set():
+                        break
+                    self.loop.call_soon_threadsafe(write, chunk)
+                if not started:
+                    self.loop.call_soon_threadsafe(begin, answer[0], list(answer[1]))
+                self.loop.call_soon_threadsafe(finish, False)
+            except Exception:
+                if not started:
+                    raise
+                # Too late for an error page
+                self.loop.call_soon_threadsafe(finish, True)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def handle(self, protocol, environ):
+        '''Answer a request, on the loop or in the pool'''
+        if inline_request(environ):
+            metrics.inc('dircloud_asyncio_requests_total', mode='inline')
+            try:
+                answer = self.call(environ)
+            except Exception as e:
+                answer = error_answer(500, '%s: %s' % (e.__class__.__name__, e))
+            protocol.respond(*answer)
+            return
+        metrics.inc('dircloud_asyncio_requests_total', mode='pool')
+        request = {'answered': False, 'timer': None}
+
+        def begin(status, headers):
+            if request['timer'] is not None:
+                request['timer'].cancel()
+            if request['answered']:
+                # Timed out meanwhile: the pool thread stops rendering
+                begin.cancelled.set()
+                return
+            request['answered'] = True
+            protocol.start(status, headers)
+
+        begin.protocol = protocol
+        begin.cancelled = threading.Event()
+
+        def write(chunk):
+            if not begin.cancelled.is_set():
+                protocol.write(chunk)
+
+        def finish(error):
+            if begin.cancelled.is_set():
+                return
+            if error:
+                protocol.abort()
+            else:
+                protocol.finish()
+
+        def done(future):
+            if request['timer'] is not None:
+                request['timer'].cancel()
+            try:
+                answer = future.result()
+            except Exception as e:
+                answer = error_answer(500, '%s: %s' % (e.__class__.__name__, e))
+            if answer is None or request['answered']:
+                # Streamed, or timed out
+                return
+            request['answered'] = True
+            protocol.respond(*answer)
+
+        def timeout():
+            if not request['answered']:
+                request['answered'] = True
+                metrics.inc('dircloud_backend_timeouts_total')
+                protocol.respond(*error_answer(504, 'Backend timed out, try again later'))
+
+        future = self.loop.run_in_executor(self.pool, self.call, environ, (begin, write, finish))
+        if args.backend_timeout and environ['REQUEST_METHOD'] in ('GET', 'HEAD'):
+            # Uploads take as long as they take
+            request['timer'] = self.loop.call_later(args.backend_timeout, timeout)
+        future.add_done_callback(done)
+
+
+def error_answer(status, message):
+    '''Status, headers and body of an error answered by the
+    AsyncioServer itself'''
+    return ('%d %s' % (status, bottle.HTTP_CODES[status]),
+            [('Content-Type', 'text/plain; charset=utf-8'),
+             ('Retry-After', str(args.retry_after))],
+            [message.encode('utf-8')])
+
+
+class AsyncioHTTPProtocol():
+    '''A client connection of the AsyncioServer.  Requests are read
+    and answered one at a time, keeping the connection open between
+    them while the client wants so.'''
+
+    max_head = 65536
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buffer = b''
+        self.body = None
+        self.busy = False
+        self.keep_alive = False
+        self.timer = None
+        self.request_line = ''
+        self.method = 'GET'
+        self.http11 = True
+        self.chunked = False
+        self.sent = 0
+        self.status = ''
+        # Cleared while the transport has too much to write, for the
+        # pool threads streaming a body (see AsyncioServer.call)
+        self.writable = threading.Event()
+        self.writable.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.wait()
+
+    def wait(self):
+        '''Close the connection if no request comes soon'''
+        self.timer = self.server.loop.call_later(self.server.keepalive, self.transport.close)
+
+    def data_received(self, data):
+        if self.body is not None:
+            self.body.feed(data)
+            return
+        self.buffer += data
+        if not self.busy:
+            self.parse()
+
+    def parse(self):
+        end = self.buffer.find(b'\r\n\r\n')
+        if end < 0:
+            if len(self.buffer) > self.max_head:
+                self.timer.cancel()
+                self.busy = True
+                self.buffer = b''
+                self.keep_alive = False
+                self.respond(*error_answer(431, 'Request header too large'))
+            return
+        head = self.buffer[:end]
+        self.buffer = self.buffer[end + 4:]
+        self.request_line = head.split(b'\r\n', 1)[0].decode('latin-1')
+        self.timer.cancel()
+        self.busy = True
+        environ = self.server.environ(head, self.transport)
+        if environ is None:
+            self.keep_alive = False
+            self.respond(*error_answer(400, 'Bad request'))
+            return
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        self.method = environ['REQUEST_METHOD']
+        self.http11 = environ['SERVER_PROTOCOL'] == 'HTTP/1.1'
+        if self.http11:
+            self.keep_alive = not 'close' in connection
+        else:
+            self.keep_alive = 'keep-alive' in connection
+        if environ.get('CONTENT_LENGTH', '0') not in ('', '0') or environ.get('HTTP_TRANSFER_ENCODING'):
+            # The application reads the body as it arrives, and
+            # knows where it ends; the connection is closed after it
+            self.keep_alive = False
+            self.body = AsyncioRequestBody(self)
+            self.body.feed(self.buffer)
+            self.buffer = b''
+            environ['wsgi.input'] = self.body
+        else:
+            environ['wsgi.input'] = io.BytesIO()
+        self.server.handle(self, environ)
+
+    def respond(self, status, headers, chunks):
+        '''Send a whole answer'''
+        if self.transport is None:
+            # The client is gone
+            return
+        names = [name.lower() for (name, value) in headers]
+        if not 'content-length' in names:
+            headers.append(('Content-Length', str(sum([len(chunk) for chunk in chunks]))))
+        self.start(status, headers)
+        self.write(b''.join(chunks))
+        self.finish()
+
+    def start(self, status, headers):
+        '''Send the head of an answer, whose body follows with write()
+        and ends with finish().  Without a length, the body is sent
+        chunked, or up to the end of the connection for HTTP/1.0
+        clients.'''
+        if self.transport is None:
+            return
+        names = [name.lower() for (name, value) in headers]
+        self.chunked = False
+        if not 'content-length' in names and self.method != 'HEAD':
+            if self.http11:
+                headers.append(('Transfer-Encoding', 'chunked'))
+                self.chunked = True
+            else:
+                self.keep_alive = False
+        if not self.keep_alive:
+            headers.append(('Connection', 'close'))
+        head = ['HTTP/1.1 %s' % (status)]
+        head += ['%s: %s' % (name, value) for (name, value) in headers]
+        self.transport.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        self.status = status
+        self.sent = 0
+
+    def write(self, chunk):
+        if self.transport is None or not chunk:
+            return
+        if self.chunked:
+            self.transport.write(('%x\r\n' % (len(chunk))).encode('ascii') + chunk + b'\r\n')
+        else:
+            self.transport.write(chunk)
+        self.sent += len(chunk)
+
+    def finish(self):
+        if self.transport is None:
+            return
+        if self.chunked:
+            self.transport.write(b'0\r\n\r\n')
+        if not self.server.quiet:
+            # Like wsgiref
+            print('%s - - [%s] "%s" %s %s' % ((self.transport.get_extra_info('peername') or ('-',))[0],
+                                             time.strftime('%d/%b/%Y %H:%M:%S'), self.request_line,
+                                             self.status.split()[0], self.sent),
+                  file=sys.stderr)
+        if not self.keep_alive:
+            self.transport.close()
+            return
+        self.busy = False
+        self.wait()
+        if self.buffer:
+            # Pipelined request
+            self.parse()
+
+    def abort(self):
+        '''Drop the connection of an answer that failed after its head
+        was sent'''
+        if self.transport is not None:
+            self.transport.close()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def eof_received(self):
+        if self.body is not None:
+            self.body.feed_eof()
+        # Keep the transport open to answer the request in progress
+        return self.busy
+
+    def connection_lost(self, exc):
+        self.transport = None
+        # Let a streaming pool thread find out
+        self.writable.set()
+        if self.body is not None:
+            self.body.feed_eof()
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+class AsyncioRequestBody():
+    '''wsgi.input of the AsyncioServer requests with a body: the pool
+    thread running the request reads what the event loop receives,
+    and the loop stops reading from the client while too much is
+    waiting to be read'''
+
+    limit = 1024 * 1024
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.buffer = bytearray()
+        self.eof = False
+        self.paused = False
+        self.condition = threading.Condition()
+
+    def feed(self, data):
+        with self.condition:
+            self.buffer += data
+            self.condition.notify()
+            if len(self.buffer) > self.limit and not self.paused and self.protocol.transport:
+                self.paused = True
+                self.protocol.transport.pause_reading()
+
+    def feed_eof(self):
+        with self.condition:
+            self.eof = True
+            self.condition.notify()
+
+    def read(self, size=-1):
+        with self.condition:
+            while not self.eof and (not self.buffer or size is None or size < 0):
+                self.condition.wait()
+            if size is None or size < 0:
+                size = len(self.buffer)
+            return self.take(size)
+
+    def readline(self, size=-1):
+        with self.condition:
+            while not self.eof and not b'\n' in self.buffer and not 0 <= size <= len(self.buffer):
+                self.condition.wait()
+            end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+            if 0 <= size < end:
+                end = size
+            return self.take(end)
+
+    def take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        if self.paused and len(self.buffer) < self.limit // 2:
+            self.paused = False
+            transport = self.protocol.transport
+            if transport:
+                self.protocol.server.loop.call_soon_threadsafe(transport.resume_reading)
+        return data
+
+
+def inline_request(environ):
+    '''Whether a request can be answered right away on the event loop
+    of the AsyncioServer: directory pages (not too big to be streamed,
+    and none when --stream_threshold is 0) and other small pages of a
+    tree kept in memory'''
+    tree = du
+    if environ['REQUEST_METHOD'] != 'GET' or not tree or tree.deep is not None or isinstance(tree, SqliteTree):
+        return False
+    path = environ['PATH_INFO'].encode('latin-1').decode('utf-8', 'ignore')
+    if path in ('/metrics', '/status', '/robots.txt', '/favicon.ico'):
+        return True
+    if 'dircloud=' in environ['QUERY_STRING'] or path.endswith(read_from_disk):
+        return False
+    if not df and not args.non_disk:
+        # The first get_df() waits for statvfs and df, in the pool
+        return False
+    directory = tree.getChildren(path.lstrip(sep) or sep)
+    return 0 < len(directory) <= args.stream_threshold
+
+
+class CommandProtocol():
+    '''Output of a command run by the event loop of the AsyncioServer
+    (see run_command)'''
+
+    def __init__(self):
+        self.transport = None
+        self.output = []
+        self.error = None
+        self.done = threading.Event()
+
+    def started(self, task):
+        if task.exception() is not None:
+            self.error = task.exception()
+            self.done.set()
+
+    def kill(self):
+        if self.transport is not None and self.transport.get_returncode() is None:
+            kill_command(self.transport.get_pid())
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def pipe_data_received(self, fd, data):
+        self.output.append(data)
+
+    def pipe_connection_lost(self, fd, exc):
+        pass
+
+    def process_exited(self):
+        pass
+
+    def connection_lost(self, exc):
+        # The command is over and its output read
+        self.transport.close()
+        self.done.set()
+
+
+def kill_command(pid):
+    '''Kill a command run by run_command, with the processes started
+    by its shell, that would keep its output open'''
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def run_command(cmd):
+    '''Return the output of a shell command, like
+    subprocess.getoutput, or answer with a 504 if it takes more than
+    --backend_timeout seconds.
+
+    With --server asyncio, the command is run and read by the event
+    loop, and the pool thread only waits for its output.'''
+    if sys.version_info[0] == 2:
+        return subprocess.getoutput(cmd)
+    timeout = args.backend_timeout or None
+    server = async_server
+    if server is not None and threading.current_thread() is not server.thread:
+        protocol = CommandProtocol()
+
+        def start():
+            task = asyncio.ensure_future(server.loop.subprocess_shell(
+                lambda: protocol, cmd, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                start_new_session=True), loop=server.loop)
+            task.add_done_callback(protocol.started)
+
+        server.loop.call_soon_threadsafe(start)
+        if not protocol.done.wait(timeout):
+            server.loop.call_soon_threadsafe(protocol.kill)
+            metrics.inc('dircloud_backend_timeouts_total')
+            raise HTTPResponse('Backend timed out, try again later', status=504,
+                               headers={'Retry-After': str(args.retry_after)})
+        if protocol.error is not None:
+            raise protocol.error
+        out = b''.join(protocol.output)
+    else:
+        process = subprocess.Popen(cmd, shell=True, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   start_new_session=True)
+        try:
+            out = process.communicate(timeout=timeout)[0]
+        except subprocess.TimeoutExpired:
+            kill_command(process.pid)
+            process.communicate()
+            metrics.inc('dircloud_backend_timeouts_total')
+            raise HTTPResponse('Backend timed out, try again later', status=504,
+                               headers={'Retry-After': str(args.retry_after)})
+    out = out.decode('utf-8', name_errors)
+    if out.endswith('\n'):
+        out = out[:-1]
+    return out
 
 
 class Tree():
@@ -50,7 +644,14 @@ class Tree():
       }
 
      It provides some level of tolerance and self-correction for ill
-     formed paths.'''
+     formed paths.
+
+     Once published as the global du, a tree is never modified in
+     place, as it may be read by several threads at once.  Writers
+     work on a copy() and publish it when done; the copy shares the
+     branch lists with the original until they are first modified.'''
+
+    page_cache_size = 100
 
     def __init__(self, filename = '', mtime=0, atime=0, broken=False, version_sort=False):
         self.filename = filename
@@ -61,13 +662,89 @@ class Tree():
         self.broken = broken
         self.version_sort = version_sort
         self.non_disk = False
+        # The parents whose children lists belong to this tree, when
+        # the others are shared with the tree it was copied from, or
+        # None when they all do
+        self.owned = None
+        self.packed = None
+        self.deep = None
+        # Values derived from the tree, like statistics or indexes.
+        # As published trees do not change, they stay valid while the
+        # tree lives.
+        self.cache = LRUCache(1000)
+        # Collation keys of the children names.  They only depend on
+        # the name, so they are shared by all the copies of the tree.
+        self.sort_keys = {}
+        # Rendered pages, see plain_directory_page()
+        self.pages = LRUCache(Tree.page_cache_size, name='pages')
 
     def __len__(self):
+        if self.deep is not None:
+            return len(self.branches) + len(self.deep)
         return len(self.branches)
 
     def __getitem__(self, name):
         return self.getBranch(name)
 
+    def copy(self):
+        '''Return a copy of the tree that can be modified without
+        disturbing the readers of this one'''
+        tree = Tree(filename=self.filename, mtime=self.mtime,
+                    atime=self.atime, broken=self.broken,
+                    version_sort=self.version_sort)
+        tree.non_disk = self.non_disk
+        tree.packed = self.packed
+        tree.deep = self.deep
+        tree.sort_keys = self.sort_keys
+        # Only the dict: the children lists are copied when modified
+        tree.branches = dict(self.branches)
+        tree.owned = set()
+        return tree
+
+    def _own(self, parent):
+        '''Make sure the branch list of parent is not shared with
+        another tree (nor packed, nor on disk) before modifying it'''
+        if self.deep is not None and not parent in self.branches and self._has(parent):
+            self.branches[parent] = [list(child) for child in self.deep.getChildren(parent)]
+        elif self.packed and parent in self.branches and not isinstance(self.branches[parent], list):
+            self.branches[parent] = self.packed.getChildren(self.branches[parent])
+        elif self.owned is not None and not parent in self.owned and parent in self.branches:
+            self.branches[parent] = [list(child) for child in self.branches[parent]]
+        if self.owned is not None:
+            # Copied above, or created by the caller
+            self.owned.add(parent)
+
+    def _has(self, parent):
+        if parent in self.branches:
+            return True
+        if self.deep is not None and parent.count(sep) > self.deep.depth:
+            return self.deep.has(parent)
+        return False
+
+    def _children(self, parent):
+        '''Return the children list of parent, unpacking it or fetching
+        it from disk if needed'''
+        if not parent in self.branches and self.deep is not None and parent.count(sep) > self.deep.depth:
+            return self.deep.getChildren(parent)
+        children = self.branches.get(parent, [])
+        if not isinstance(children, list):
+            children = self.packed.getChildren(children)
+        return children
+
+    def pack(self):
+        '''Move the children of all branches to a few flat buffers.
+
+        A packed tree needs much less memory, and its data is not made
+        of millions of small objects whose reference counts and
+        garbage collector flags get written when read.  Pages of a
+        packed tree loaded before forking stay shared by all the
+        worker processes.  Branches are unpacked again when modified.
+        '''
+        if not self.packed:
+            self.packed = PackedBranches(self.branches)
+            self.branches = self.packed.index
+            self.owned = None
+
     def splitParentChild(self, name):
         '''Split a path between parent and child'''
         if name == sep:
@@ -77,17 +754,24 @@ class Tree():
             (parent, child) = os.path.split(name.rstrip(sep))
             parent += sep
             child += sep
-        if not parent in self.branches:
-            self.branches[parent] = []
         return (parent, child)
 
-    def addBranch(self, name, values, is_directory=True):
+    def addBranch(self, name, values, is_directory=True, sort=True):
+        '''Add a child to its parent branch.  With sort=False, the
+        children are left unsorted, and sortBranches() must be called
+        once all of them are added.'''
         (parent, child) = self.splitParentChild(name)
         if not is_directory:
             child = child.rstrip(sep)
         values = [child, values[0], values[1]]
-        self.branches[parent].append(values)
-        self.branches[parent].sort()
+        if self.deep is not None and self.deep.writing and parent.count(sep) > self.deep.depth:
+            # Ingesting: deep branches go straight to disk
+            self.deep.add(parent, values)
+            return
+        self._own(parent)
+        self.branches.setdefault(parent, []).append(values)
+        if sort:
+            self.branches[parent].sort()
         if self.broken:
             # Add values to parents
             value = values[0]
@@ -96,12 +780,23 @@ class Tree():
                 self.sumToBranch(parent, value)
                 parent = self.getParentName(parent)
 
+    def sortBranches(self, parents=None):
+        '''Sort the children of all the branches, or only of the
+        parents given, after adding them with addBranch(sort=False)'''
+        if parents is None:
+            parents = self.branches
+        for parent in parents:
+            children = self.branches.get(parent)
+            if isinstance(children, list):
+                children.sort()
+
     def updateBranch(self, name, values):
-        if not name in self.branches:
+        if not self._has(name):
             name = self._normpath(name)
         old_value = self.branch[name][0]
         new_value = values[0]
         diff = old_value - new_value
+        self._own(name)
         self.branches[name] = values
         if self.broken:
             # Sync values to parents
@@ -112,9 +807,10 @@ class Tree():
 
     def sumToBranch(self, name, value):
         (parent, child) = self.splitParentChild(name)
-        if not parent in self.branches:
-            self.branches[parent] = [child, 0, '']
-        if parent in self.branches:
+        self._own(parent)
+        if not self._has(parent):
+            self.branches[parent] = [[child, 0, '']]
+        if self._has(parent):
             for i in range(len(self.branches[parent])):
                 if self.branches[parent][i][0] == child:
                     self.branches[parent][i][1] += value
@@ -123,12 +819,13 @@ class Tree():
         if not name:
             name = '/'
         (parent, child) = self.splitParentChild(name)
-        if not parent in self.branches:
+        if not self._has(parent):
             name = self._normpath(name)
-        if parent in self.branches:
-            for i in range(len(self.branches[parent])):
-                if self.branches[parent][i][0] == child:
-                    return self.branches[parent][i]
+        if self._has(parent):
+            children = self._children(parent)
+            for i in range(len(children)):
+                if children[i][0] == child:
+                    return children[i]
         else:
             return self.empty
 
@@ -144,10 +841,11 @@ class Tree():
         '''
         timestamp = ''
         (parent, child) = self.splitParentChild(name)
-        if parent in self.branches:
-            for i in range(len(self.branches[parent])):
-                if self.branches[parent][i][0] == child:
-                    timestamp = self.branches[parent][i][2]
+        if self._has(parent):
+            children = self._children(parent)
+            for i in range(len(children)):
+                if children[i][0] == child:
+                    timestamp = children[i][2]
         return timestamp
 
     def getBranchKey(self, name):
@@ -158,44 +856,55 @@ class Tree():
         two places: timestamp field and leaf node.  Only the first
         found option is considered.
         '''
-        timestamp = du.getBranchTimestamp(name)
-        if timestamp:
+        timestamp = self.getBranchTimestamp(name)
+        if timestamp and not isinstance(timestamp, int):
             key = timestamp
         else:
             key = name.split(sep)[-2]
         return key
 
     def getParentName(self, name):
-        if not name in self.branches:
+        if not self._has(name):
             name = self._normpath(name)
         (parent, child) = self.splitParentChild(name)
         return parent
 
     def delBranch(self, name):
-        if not name in self.branches:
+        if not self._has(name):
             name = self._normpath(name)
-        if name in self.branches:
+        if self._has(name):
             (parent, child) = self.splitParentChild(name)
-            for i in range(len(self.branches[parent])):
-                if self.branches[parent][i][0] == child:
-                    value = -self.branches[parent][i][1]
+            children = self._children(parent)
+            for i in range(len(children)):
+                if children[i][0] == child:
+                    value = -children[i][1]
             parent = self.getParentName(name)
             while parent:
                 self.sumToBranch(parent, value)
                 parent = self.getParentName(parent)
+            self._own(name)
             del self.branches[name]
 
     def getChildren(self, name):
-        if not name in self.branches:
+        if not self._has(name):
             name = self._normpath(name)
-        if not name in self.branches:
+        if not self._has(name):
             name += sep
         children = []
-        if name in self.branches:
-            for i in range(len(self.branches[name])):
-                children.append(self.branches[name][i])
+        if self._has(name):
+            branch = self._children(name)
+            for i in range(len(branch)):
+                children.append(branch[i])
         return children
 
+    def sortKey(self, name):
+        '''Collation key of a children name, computed once per name'''
+        key = self.sort_keys.get(name)
+        if key is None:
+            key = collation_key(name, self.version_sort)
+            self.sort_keys[name] = key
+        return key
+
     def getLastDescendantBranch(self, branch):
         '''Look for the last value (filename) of the longest branch
         (calculated as the branch with most path separators).
@@ -206,21 +915,33 @@ class Tree():
         pairs.
         '''
 
-        branches = self.getBranchNames(branch)
+        branches = self.getBranchNames(branch, sort=False)
         names = [(child.count(sep), child) for child in branches]
         name = max(names)
         return name[-1]
 
+    def iterBranches(self, branch=''):
+        '''Generate (parent, children) pairs for all the branches,
+        starting with named branch'''
+        for parent in self.branches:
+            if not branch or parent.startswith(branch):
+                yield (parent, self.getChildren(parent))
+        if self.deep is not None:
+            for (parent, children) in self.deep.iterBranches():
+                if parent in self.branches:
+                    # Modified since ingestion, already listed
+                    continue
+                if not branch or parent.startswith(branch):
+                    yield (parent, children)
+
     def getBranchNames(self, branch='', sort=True):
         '''Get a list of all branches names, starting with named
         branch, including leaf nodes'''
 
         branches = []
-        for parent in self.branches:
-            if not branch or parent.startswith(branch):
-                children = self.getChildren(parent)
-                for child in children:
-                    branches.append(os.path.join(parent, child[0]))
+        for (parent, children) in self.iterBranches(branch):
+            for child in children:
+                branches.append(os.path.join(parent, child[0]))
 
         if sort:
             if self.version_sort:
@@ -229,30 +950,871 @@ class Tree():
                 branches.sort()
         return branches
 
+    def searchNames(self, q):
+        '''Get the unsorted list of branch names containing q'''
+        return [line for line in self.getBranchNames(sort=False) if line.count(q)]
+
     def _normpath(self, name):
-        if name in self.branches:
+        if self._has(name):
             return name
-        elif name + sep in self.branches:
+        elif self._has(name + sep):
             return name + sep
         else:
             return os.path.normpath(name)
 
 
+class PackedBranches():
+    '''Children of all the branches of a tree, stored in flat buffers.
+
+    Names and timestamps of all the children are kept in two big
+    NUL-separated byte strings and their sizes in an array, in branch
+    order.  index maps each branch name to its position, which
+    locates its slices in the buffers through the offset arrays.
+    '''
+
+    def __init__(self, branches):
+        self.index = {}
+        self.sizes = array('q')
+        self.children_offsets = array('q', [0])
+        self.names_offsets = array('q', [0])
+        self.mtimes_offsets = array('q', [0])
+        names = []
+        mtimes = []
+        names_length = 0
+        mtimes_length = 0
+        for parent in branches:
+            self.index[parent] = len(self.index)
+            children = branches[parent]
+            chunk = self._encode([child[0] for child in children])
+            names.append(chunk)
+            names_length += len(chunk)
+            chunk = self._encode([self._encode_mtime(child[2]) for child in children])
+            mtimes.append(chunk)
+            mtimes_length += len(chunk)
+            self.sizes.extend([child[1] for child in children])
+            self.children_offsets.append(len(self.sizes))
+            self.names_offsets.append(names_length)
+            self.mtimes_offsets.append(mtimes_length)
+        self.names = b''.join(names)
+        self.mtimes = b''.join(mtimes)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def _encode(self, values):
+        return ''.join([value + '\0' for value in values]).encode('utf-8', name_errors)
+
+    def _decode(self, chunk):
+        return chunk.decode('utf-8', name_errors).split('\0')[:-1]
+
+    def _encode_mtime(self, mtime):
+        '''Timestamps are kept as text: integers (parsed dates) get an
+        @ prefix, and strings that could be mistaken for them an =.'''
+        if isinstance(mtime, int):
+            return '@%d' % (mtime)
+        elif mtime.startswith(('@', '=')):
+            return '=' + mtime
+        return mtime
+
+    def _decode_mtime(self, mtime):
+        if mtime.startswith('@'):
+            return int(mtime[1:])
+        elif mtime.startswith('='):
+            return mtime[1:]
+        return mtime
+
+    def getChildren(self, i):
+        '''Return the children of the i-th branch as a list of [name,
+        size, mtime] lists, as found in unpacked trees'''
+        names = self._decode(self.names[self.names_offsets[i]:self.names_offsets[i + 1]])
+        mtimes = [self._decode_mtime(mtime) for mtime in
+                  self._decode(self.mtimes[self.mtimes_offsets[i]:self.mtimes_offsets[i + 1]])]
+        sizes = self.sizes[self.children_offsets[i]:self.children_offsets[i + 1]]
+        return [[names[j], sizes[j], mtimes[j]] for j in range(len(names))]
+
+
+def sql_text(name):
+    '''Bind name as sqlite text.  sqlite3 cannot encode the surrogates
+    that stand for the bytes of names not valid in UTF-8 (see
+    parse_du), so those names are bound as their bytes, that the
+    queries cast back to text (see sql_connect)'''
+    if name_errors == 'surrogateescape' and surrogate_re.search(name):
+        return name.encode('utf-8', name_errors)
+    return name
+
+
+def sql_prefix_end(branch):
+    '''Upper bound of the paths that start with branch.  It holds for
+    the bytes of names not valid in UTF-8 too, that may sort after
+    any character.'''
+    return branch[:-1] + u'%c' % (ord(branch[-1]) + 1)
+
+
+def sql_connect(filename):
+    '''Connect to an sqlite tree, decoding its text like parse_du'''
+    connection = sqlite3.connect(filename)
+    connection.text_factory = lambda data: data.decode('utf-8', name_errors)
+    return connection
+
+
+def make_sibling_file(filename):
+    '''Create an empty, uniquely named file next to filename, to be
+    renamed over it once written.  An /ingest and a background reload
+    of the same process may build the same file at the same time'''
+    (fd, new_filename) = tempfile.mkstemp(prefix=os.path.basename(filename) + '.',
+                                          suffix='.new',
+                                          dir=os.path.dirname(filename) or '.')
+    os.close(fd)
+    return new_filename
+
+
+class DeepBranches():
+    '''Branches deeper than depth levels of a tree, kept in an sqlite
+    index on disk instead of in memory.
+
+    While ingesting, children are appended with add() and written in
+    batches; finish() indexes them and makes the file available to
+    readers, that fetch the children lists through an LRU cache.  Each
+    thread (and process, after forking) opens its own read only
+    connection.  The index is built aside and renamed over the
+    previous one, so open connections of an older tree keep seeing the
+    old data.
+    '''
+
+    def __init__(self, filename, depth, cache_size=10000):
+        self.filename = filename
+        self.depth = depth
+        self.count = 0
+        self.cache = LRUCache(cache_size, name='deep_branches')
+        self.local = threading.local()
+        self.pending = []
+        self.writing = True
+        self.new_filename = make_sibling_file(filename)
+        self.writer = sql_connect(self.new_filename)
+        self.writer.execute('create table children (parent text, name text, size integer, mtime);')
+
+    def __len__(self):
+        return self.count
+
+    def add(self, parent, values):
+        self.pending.append((sql_text(parent), sql_text(values[0]), values[1], values[2]))
+        if len(self.pending) >= 10000:
+            self.flush()
+
+    def flush(self):
+        self.writer.executemany('insert into children values (cast(? as text), cast(? as text), ?, ?);', self.pending)
+        self.pending = []
+
+    def finish(self):
+        self.flush()
+        self.writer.execute('create index children_parent on children (parent, name);')
+        self.count = self.writer.execute('select count(distinct parent) from children;').fetchone()[0]
+        self.writer.commit()
+        self.writer.close()
+        self.writer = None
+        os.rename(self.new_filename, self.filename)
+        self.writing = False
+
+    def abort(self):
+        '''Drop the index being built, after a failed load'''
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        try:
+            os.remove(self.new_filename)
+        except OSError:
+            pass
+
+    def connection(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connection = sql_connect(self.filename)
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def has(self, parent):
+        return bool(self.getChildren(parent))
+
+    def getChildren(self, parent):
+        if self.writing:
+            return []
+        children = self.cache.get(parent)
+        if children is None:
+            sql = 'select name, size, mtime from children where parent = cast(? as text) order by name;'
+            children = [list(row) for row in self.connection().execute(sql, (sql_text(parent),))]
+            self.cache.set(parent, children)
+        return children
+
+    def iterBranches(self):
+        '''Generate (parent, children) pairs for all the deep branches'''
+        if self.writing:
+            return
+        sql = 'select parent, name, size, mtime from children order by parent, name;'
+        parent = None
+        children = []
+        for row in self.connection().execute(sql):
+            if row[0] != parent:
+                if children:
+                    yield (parent, children)
+                parent = row[0]
+                children = []
+            children.append([row[1], row[2], row[3]])
+        if children:
+            yield (parent, children)
+
+
+class SqliteTree(Tree):
+    '''Tree stored in an sqlite database instead of in memory.
+
+    Each child is a row of the nodes table with its parent_id, name,
+    size, mtime and full path, and branches that are nobody's child
+    (the root) get a row of their own.  Lookups are indexed queries,
+    so memory use does not depend on the size of the tree.  The
+    database keeps the du file name and mtime, so it can be reused
+    without parsing on restart, and shared by several processes.
+
+    Branches modified after ingestion are kept in memory, in branches,
+    and take precedence over the database ones.
+
+    Paths are also indexed by trigrams in the nodes_search full text
+    table, where sqlite has them (3.34 and later), so that substring
+    searches of three or more characters do not scan all the nodes.
+    '''
+
+    # Databases written by other versions of the schema are ingested again
+    version = '3'
+
+    def __init__(self, dbname, cache_size=10000, **kwargs):
+        Tree.__init__(self, **kwargs)
+        self.dbname = dbname
+        self.count = 0
+        self.children = 0
+        self.trigrams = False
+        self.local = threading.local()
+        self.children_cache = LRUCache(cache_size, name='sqlite_tree')
+        self.writer = None
+        self.writing = False
+        self.pending = []
+
+    def __len__(self):
+        return self.count + len([parent for parent in self.branches
+                                 if not self._has_in_db(parent)])
+
+    @classmethod
+    def open(cls, dbname, filename, mtime, **kwargs):
+        '''Return the tree stored in dbname if it was ingested from
+        filename with this mtime, None otherwise'''
+        if not os.path.isfile(dbname):
+            return None
+        try:
+            connection = sqlite3.connect(dbname)
+            meta = dict(connection.execute('select key, value from meta;').fetchall())
+            connection.close()
+        except sqlite3.Error:
+            return None
+        if (meta.get('filename') != filename or float(meta.get('mtime', 0)) != mtime
+            or meta.get('version') != cls.version):
+            return None
+        tree = cls(dbname, filename=filename, mtime=mtime,
+                   atime=float(meta['atime']), **kwargs)
+        tree.count = int(meta['count'])
+        tree.children = int(meta['children'])
+        tree.trigrams = meta['trigrams'] == '1'
+        return tree
+
+    def copy(self):
+        tree = SqliteTree(self.dbname, filename=self.filename,
+                          mtime=self.mtime, atime=self.atime,
+                          broken=self.broken, version_sort=self.version_sort)
+        tree.non_disk = self.non_disk
+        tree.count = self.count
+        tree.children = self.children
+        tree.trigrams = self.trigrams
+        tree.local = self.local
+        tree.children_cache = self.children_cache
+        tree.sort_keys = self.sort_keys
+        tree.branches = dict(self.branches)
+        tree.owned = set()
+        return tree
+
+    def pack(self):
+        pass
+
+    def begin(self):
+        '''Start ingesting into a new database, built aside and renamed
+        over dbname by finish()'''
+        self.new_dbname = make_sibling_file(self.dbname)
+        self.writer = sql_connect(self.new_dbname)
+        self.writer.execute('create table staging (parent text, name text, size integer, mtime);')
+        self.writing = True
+
+    def addBranch(self, name, values, is_directory=True, sort=True):
+        if not self.writing:
+            return Tree.addBranch(self, name, values, is_directory, sort)
+        (parent, child) = self.splitParentChild(name)
+        if not is_directory:
+            child = child.rstrip(sep)
+        self.pending.append((sql_text(parent), sql_text(child), values[0], values[1]))
+        if len(self.pending) >= 10000:
+            self.flush()
+
+    def flush(self):
+        self.writer.executemany('insert into staging values (cast(? as text), cast(? as text), ?, ?);', self.pending)
+        self.pending = []
+
+    def finish(self):
+        self.flush()
+        sql = [
+            'create table nodes (id integer primary key, parent_id integer, name text, size integer, mtime, path text);',
+            # Children of the same parent get consecutive ids, and
+            # thus pages
+            'insert into nodes (name, size, mtime, path) select name, size, mtime, parent || name from staging order by parent, name;',
+            'create index nodes_path on nodes (path);',
+            "insert into nodes (name, size, mtime, path) select distinct '', 0, '', parent from staging where parent not in (select path from nodes);",
+            "update nodes set parent_id = (select p.id from nodes p where p.path = substr(nodes.path, 1, length(nodes.path) - length(nodes.name))) where name != '';",
+            'create index nodes_parent on nodes (parent_id, name);',
+            'drop table staging;',
+            'create table meta (key text primary key, value text);',
+            ]
+        for statement in sql:
+            self.writer.execute(statement)
+        try:
+            self.writer.execute("create virtual table nodes_search using fts5(path, tokenize='trigram case_sensitive 1', content='nodes', content_rowid='id');")
+            self.writer.execute("insert into nodes_search (rowid, path) select id, path from nodes where name != '';")
+            self.trigrams = True
+        except sqlite3.OperationalError:
+            # No fts5, or no trigram tokenizer: searches scan the nodes
+            self.trigrams = False
+        self.count = self.writer.execute('select count(distinct parent_id) from nodes;').fetchone()[0]
+        self.children = self.writer.execute("select count(*) from nodes where name != '';").fetchone()[0]
+        meta = {'filename': self.filename, 'mtime': repr(self.mtime),
+                'atime': repr(self.atime), 'count': str(self.count),
+                'children': str(self.children),
+                'trigrams': str(int(self.trigrams)),
+                'version': self.version}
+        self.writer.executemany('insert into meta values (?, ?);', meta.items())
+        self.writer.commit()
+        self.writer.close()
+        self.writer = None
+        os.rename(self.new_dbname, self.dbname)
+        self.writing = False
+
+    def abort(self):
+        '''Drop the database being built, after a failed load'''
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        try:
+            os.remove(self.new_dbname)
+        except OSError:
+            pass
+
+    def connection(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connection = sql_connect(self.dbname)
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def _has_in_db(self, parent):
+        sql = 'select 1 from nodes n join nodes p on n.parent_id = p.id where p.path = cast(? as text) limit 1;'
+        return bool(self.connection().execute(sql, (sql_text(parent),)).fetchone())
+
+    def _has(self, parent):
+        if parent in self.branches:
+            return True
+        if self.writing:
+            return False
+        return bool(self._children(parent))
+
+    def _own(self, parent):
+        if not parent in self.branches and self._has(parent):
+            self.branches[parent] = [list(child) for child in self._children(parent)]
+            if self.owned is not None:
+                self.owned.add(parent)
+        Tree._own(self, parent)
+
+    def _children(self, parent):
+        if parent in self.branches or self.writing:
+            return self.branches.get(parent, [])
+        children = self.children_cache.get(parent)
+        if children is None:
+            sql = 'select n.name, n.size, n.mtime from nodes n join nodes p on n.parent_id = p.id where p.path = cast(? as text) order by n.name;'
+            children = [list(row) for row in self.connection().execute(sql, (sql_text(parent),))]
+            self.children_cache.set(parent, children)
+        return children
+
+    def getBranch(self, name):
+        if not name:
+            name = '/'
+        (parent, child) = self.splitParentChild(name)
+        if parent in self.branches or self.writing:
+            return Tree.getBranch(self, name)
+        row = self.connection().execute('select name, size, mtime from nodes where path = cast(? as text) and parent_id is not null;',
+                                        (sql_text(parent + child),)).fetchone()
+        if row:
+            return list(row)
+        return self.empty
+
+    def iterBranches(self, branch=''):
+        if self.writing:
+            return
+        sql = 'select p.path, n.name, n.size, n.mtime from nodes n join nodes p on n.parent_id = p.id'
+        if branch:
+            rows = self.connection().execute(sql + ' where p.path >= cast(? as text) and p.path < cast(? as text) order by n.parent_id, n.name;',
+                                             (sql_text(branch), sql_text(sql_prefix_end(branch))))
+        else:
+            rows = self.connection().execute(sql + ' order by n.parent_id, n.name;')
+        parent = None
+        children = []
+        for row in rows:
+            if row[0] != parent:
+                if children and not parent in self.branches:
+                    yield (parent, children)
+                parent = row[0]
+                children = []
+            children.append([row[1], row[2], row[3]])
+        if children and not parent in self.branches:
+            yield (parent, children)
+        for parent in list(self.branches):
+            if not branch or parent.startswith(branch):
+                yield (parent, self.branches[parent])
+
+    def getBranchNames(self, branch='', sort=True):
+        sql = 'select p.path, n.path from nodes n join nodes p on n.parent_id = p.id'
+        if branch:
+            rows = self.connection().execute(sql + ' where p.path >= cast(? as text) and p.path < cast(? as text);',
+                                             (sql_text(branch), sql_text(sql_prefix_end(branch))))
+        else:
+            rows = self.connection().execute(sql + ';')
+        branches = [row[1] for row in rows if not row[0] in self.branches]
+        for parent in self.branches:
+            if not branch or parent.startswith(branch):
+                for child in self.branches[parent]:
+                    branches.append(os.path.join(parent, child[0]))
+        if sort:
+            if self.version_sort:
+                branches.sort(key=version_key)
+            else:
+                branches.sort()
+        return branches
+
+    def searchNames(self, q):
+        if self.trigrams and len(q) >= 3:
+            # A phrase of trigrams is a substring
+            sql = 'select p.path, n.path from nodes_search s join nodes n on n.id = s.rowid join nodes p on n.parent_id = p.id where nodes_search match cast(? as text);'
+            rows = self.connection().execute(sql, (sql_text('"%s"' % (q.replace('"', '""'))),))
+        else:
+            sql = 'select p.path, n.path from nodes n join nodes p on n.parent_id = p.id where instr(n.path, cast(? as text)) > 0;'
+            rows = self.connection().execute(sql, (sql_text(q),))
+        branches = [row[1] for row in rows if not row[0] in self.branches]
+        for parent in self.branches:
+            for child in self.branches[parent]:
+                name = os.path.join(parent, child[0])
+                if name.count(q):
+                    branches.append(name)
+        return branches
+
+
+class SingleFlight():
+    '''Run only one call of an operation per key at a time.
+
+    Callers asking for a key already in flight wait for it, up to
+    timeout seconds, and share its result, or its exception, instead
+    of running the operation again.  Waiters that time out get a
+    SingleFlightTimeout.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function, timeout=None):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'done': threading.Event(), 'result': None, 'error': None}
+                self.calls[key] = call
+        if leader:
+            try:
+                call['result'] = function()
+            except Exception as e:
+                call['error'] = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call['done'].set()
+        else:
+            metrics.inc('dircloud_coalesced_requests_total', operation=self.name)
+            if not call['done'].wait(timeout):
+                raise SingleFlightTimeout('%s %s still running after %s seconds' % (self.name, key, timeout))
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+
+
+class SingleFlightTimeout(Exception):
+    pass
+
+
+class ConnectionPool():
+    '''A few connections to a backend, shared by the threads of the
+    server.  A request borrows one with connection() and gives it back
+    when done, so that at most size of them stay open between
+    requests however many threads the server runs.  Connections that
+    fail are closed instead of given back.'''
+
+    def __init__(self, connect, size=4):
+        self.connect = connect
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = []
+        self.pid = os.getpid()
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = None
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked: the connections belong to the parent
+                self.idle = []
+                self.pid = os.getpid()
+            if self.idle:
+                connection = self.idle.pop()
+        if connection is None:
+            connection = self.connect()
+        try:
+            yield connection
+        except Exception:
+            self.close(connection)
+            raise
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                connection = None
+        if connection is not None:
+            self.close(connection)
+
+    def close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+class LRUCache():
+    '''Minimal thread-safe mapping that keeps only the most recently
+    used maxsize items.  Hits and misses of named caches are counted
+    in the metrics.'''
+
+    def __init__(self, maxsize=1000, name=''):
+        self.maxsize = maxsize
+        self.name = name
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        with self.lock:
+            hit = key in self.items
+            if hit:
+                value = self.items.pop(key)
+                self.items[key] = value
+            else:
+                value = default
+        if self.name:
+            if hit:
+                metrics.inc('dircloud_cache_hits_total', cache=self.name)
+            else:
+                metrics.inc('dircloud_cache_misses_total', cache=self.name)
+        return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            if key in self.items:
+                del self.items[key]
+            elif len(self.items) >= self.maxsize:
+                self.items.popitem(last=False)
+            self.items[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class Metrics():
+    '''Counters, gauges and latency histograms, exported in the
+    Prometheus text format by the /metrics route'''
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            if not key in self.histograms:
+                # One counter per bucket, plus sum and count
+                self.histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram = self.histograms[key]
+            for i in range(len(self.buckets)):
+                if seconds <= self.buckets[i]:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def timed(self, name, **labels):
+        '''Decorator to observe the running time of a function'''
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def format(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted([(key, list(value)) for (key, value) in self.histograms.items()])
+        declared = set()
+        for (metrics, kind) in ((counters, 'counter'), (gauges, 'gauge')):
+            for ((name, labels), value) in metrics:
+                if not name in declared:
+                    lines.append('# TYPE %s %s' % (name, kind))
+                    declared.add(name)
+                lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for ((name, labels), histogram) in histograms:
+            if not name in declared:
+                lines.append('# TYPE %s histogram' % (name))
+                declared.add(name)
+            for i in range(len(self.buckets)):
+                le = labels + (('le', str(self.buckets[i])),)
+                lines.append('%s_bucket%s %s' % (name, format_labels(le), histogram[i]))
+            le = labels + (('le', '+Inf'),)
+            lines.append('%s_bucket%s %s' % (name, format_labels(le), histogram[-1]))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), histogram[-2]))
+            lines.append('%s_count%s %s' % (name, format_labels(labels), histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join(['%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                               for (label, value) in labels]))
+
+
+metrics = Metrics()
+# Held while a request is being profiled, only ever try-acquired
+profile_lock = threading.Lock()
+# next() on a count is atomic, no lock needed
+profile_counter = itertools.count(1)
 du = Tree()
+async_server = None
 df = []
+du_lock = threading.Lock()
+loader = None
+loader_lock = threading.Lock()
+progress = {'filename': '', 'bytes_read': 0, 'bytes_total': 0,
+            'start': 0, 'end': 0, 'error': ''}
+hosts = {}
+page_hits = {}
+page_hits_lock = threading.Lock()
+memory_records = []
+memory_lock = threading.Lock()
+ingest_lock = threading.Lock()
+disk_cache = {}
+disk_cache_lock = threading.Lock()
+disk_pool = None
+df_refresh = None
+df_lock = threading.Lock()
+hung_mounts = {}
+fallback_cache = LRUCache(name='openfile_fallback')
+disk_flight = SingleFlight('read_from_disk')
+search_flight = SingleFlight('search')
+fallback_pools = {}
+fallback_pools_lock = threading.Lock()
+dico_local = threading.local()
 sep = os.path.sep
 read_from_disk = '!'
 locale.setlocale(locale.LC_ALL, '')
 
 
+@hook('before_request')
+def start_request_timer():
+    request.environ['dircloud.start'] = time.time()
+
+
+@hook('after_request')
+def stop_request_timer():
+    start = request.environ.get('dircloud.start')
+    route = request.environ.get('bottle.route')
+    if start and route:
+        metrics.observe('dircloud_request_duration_seconds',
+                        time.time() - start, route=route.callback.__name__)
+
+
+def is_admin():
+    '''Whether the request carries the --admin_key, as admin_key
+    query parameter or X-Dircloud-Admin-Key header'''
+    if not args.admin_key:
+        return False
+    key = request.GET.get('admin_key') or request.headers.get('X-Dircloud-Admin-Key') or ''
+    return hmac.compare_digest(str(key), str(args.admin_key))
+
+
+def profiled(function):
+    '''Decorator to profile some requests with cProfile.
+
+    Every --profile_every requests (or DIRCLOUD_PROFILE environment
+    variable), and any admin request with a profile query parameter,
+    are profiled and the results written in --profile_dir.  Only one
+    request is profiled at a time; the others run unprofiled.  A
+    streamed body is profiled until its last chunk is sent.
+    '''
+    @functools.wraps(function)
+    def wrapper(*args_, **kwargs):
+        n = next(profile_counter)
+        sampled = args.profile_every and n % args.profile_every == 0
+        if not (sampled or (request.GET.get('profile') and is_admin())):
+            return function(*args_, **kwargs)
+        if not profile_lock.acquire(False):
+            return function(*args_, **kwargs)
+        body = ProfiledBody(function.__name__)
+        try:
+            body.enable()
+            try:
+                result = function(*args_, **kwargs)
+            finally:
+                body.disable()
+            if isinstance(result, types.GeneratorType):
+                body.body = result
+                return body
+        except BaseException:
+            body.close()
+            raise
+        body.close()
+        return result
+    return wrapper
+
+
+class ProfiledBody(object):
+    '''Iterable over a streamed body that keeps profiling while the
+    chunks are generated, and writes the profile once closed'''
+
+    def __init__(self, name):
+        self.name = name
+        self.body = None
+        self.profiler = cProfile.Profile()
+        self.start = time.time()
+        self.closed = False
+
+    def enable(self):
+        self.profiler.enable()
+
+    def disable(self):
+        self.profiler.disable()
+
+    def __iter__(self):
+        while True:
+            self.enable()
+            try:
+                chunk = next(self.body)
+            except StopIteration:
+                return
+            finally:
+                self.disable()
+            yield chunk
+
+    def close(self):
+        '''Called by the WSGI server, even if the body was not read'''
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.body is not None:
+                self.enable()
+                try:
+                    self.body.close()
+                finally:
+                    self.disable()
+        finally:
+            try:
+                write_profile(self.profiler, self.name, self.start)
+            finally:
+                profile_lock.release()
+
+
+def write_profile(profiler, name, start):
+    '''Save a request profile in --profile_dir, as pstats file or as
+    collapsed stacks for flame graph tools'''
+    basename = '%s-%s-%s-%d' % (name, time.strftime('%Y%m%d-%H%M%S', time.localtime(start)),
+                                os.getpid(), int(start * 1000000) % 1000000)
+    filename = os.path.join(args.profile_dir, basename)
+    try:
+        if args.profile_format == 'collapsed':
+            stats = pstats.Stats(profiler)
+            f = open(filename + '.collapsed', 'w')
+            # cProfile only records callers, not whole stacks, so we
+            # can only give caller;callee pairs, weighted by the
+            # microseconds spent in the callee when called from there.
+            for (callee, (cc, nc, tt, ct, callers)) in stats.stats.items():
+                if not callers:
+                    print('%s %d' % (pstats.func_std_string(callee), tt * 1000000), file=f)
+                for (caller, values) in callers.items():
+                    print('%s;%s %d' % (pstats.func_std_string(caller),
+                                        pstats.func_std_string(callee),
+                                        values[2] * 1000000), file=f)
+            f.close()
+        else:
+            profiler.dump_stats(filename + '.pstats')
+    except (IOError, OSError) as e:
+        print('Cannot write profile %s: %s' % (filename, e), file=sys.stderr)
+
+
 @route('/')
 @route('/:dirpath#.+#')
+@profiled
 def dircloud(dirpath='/'):
-    global du, df
-    du = read_du_file_maybe(args.filename)
+    global df
+    # Work on a snapshot: a reload or a read from disk may publish a
+    # new tree while we are still building this page.
+    tree = current_tree()
 
-    if not df or df.atime < du.atime:
-        df = read_df_output()
+    df = get_df()
 
     special = request.GET.get('dircloud')
     if special == 'credits':
@@ -261,11 +1823,24 @@ def dircloud(dirpath='/'):
         page = statistics_page()
     elif special in ['available', 'size', 'used']:
         page = space_page(special)
+    elif special == 'largest':
+        try:
+            n = int(request.GET.get('n') or 100)
+        except ValueError:
+            raise HTTPResponse('Wrong number: %s' % (request.GET.get('n')), status=400)
+        # Negative numbers would slice from the end
+        page = largest_page(tree, dirpath, max(1, min(n, args.largest)))
+    elif special == 'types':
+        try:
+            n = int(request.GET.get('n') or 50)
+        except ValueError:
+            raise HTTPResponse('Wrong number: %s' % (request.GET.get('n')), status=400)
+        page = types_page(tree, dirpath, max(1, n))
     else:
         directory = []
         if dirpath.endswith(read_from_disk):
             if args.non_disk:
-                directory = du.getChildren(dirpath.rstrip(read_from_disk))
+                directory = tree.getChildren(dirpath.rstrip(read_from_disk))
             else:
                 directory = read_directory_from_disk(dirpath.rstrip(read_from_disk))
             if len(directory) == 1 and args.openfile_fallback:
@@ -275,20 +1850,26 @@ def dircloud(dirpath='/'):
                 # number is (1).  In that case, go straight to read
                 # the final node without needing to visit each
                 # descending branch.
-                dirname = du.getLastDescendantBranch(dirpath.rstrip(read_from_disk))
-                key = du.getBranchKey(dirname)
+                dirname = tree.getLastDescendantBranch(dirpath.rstrip(read_from_disk))
+                key = tree.getBranchKey(dirname)
                 return openfile_fallback(key)
         else:
             # No special request.  This should be the common case.
             # Get directory for the requested path.
-            directory = du.getChildren(dirpath)
+            with metrics.timer('dircloud_stage_duration_seconds', stage='getChildren'):
+                directory = tree.getChildren(dirpath)
             if directory and not dirpath.endswith(sep):
-                redirect(dirpath + sep)
+                redirect(dirpath + sep + query_suffix())
+        if directory and not request.query_string and not dirpath.endswith(read_from_disk):
+            record_hit(dirpath)
+            page = plain_directory_page(tree, dirpath, directory)
+            if page is not None:
+                return page
         if directory:
-            entries = len(directory)
-            total_size = du.getBranchSize(dirpath.rstrip(read_from_disk))
-            header = '<div class="stale_info">%s directories, <a href="/?dircloud=statistics">%s</a></div>' % (entries, human_readable(total_size))
-            footer = ''
+            return directory_page(tree, dirpath, directory,
+                                  request_filters(), query_suffix(),
+                                  request_order(), sort_links(),
+                                  stream=True)
         else:
             if dirpath == read_from_disk:
                 dirname = args.document_root
@@ -301,8 +1882,10 @@ def dircloud(dirpath='/'):
                 # (possibly outdated) du structure.  Read it from disk
                 # and treat it as a normal branch.
                 if not dirname.endswith(sep):
-                    redirect(dirname + sep)
+                    redirect(dirname + sep + query_suffix())
                 directory = read_directory_from_disk(dirname)
+                directory = filter_directory(None, dirname, directory,
+                                             request_filters(), request_order())
                 header = read_file_if_exists(dirname, args.header_name)
                 footer = read_file_if_exists(dirname, args.readme_name)
             elif os.path.isfile(dirname):
@@ -317,22 +1900,300 @@ def dircloud(dirpath='/'):
                 # Not found as du branch, nor disk directory nor file.
                 # If there is a openfile_fallback parameter, get the
                 # key an retrieve the results.
-                key = du.getBranchKey(dirname)
+                key = tree.getBranchKey(dirname)
                 return openfile_fallback(key)
             else:
                 return 'Unknown %s' % (dirname)
 
-        cloud = make_cloud(dirpath, directory)
+        cloud = make_cloud(dirpath, directory, suffix=query_suffix())
         page = make_html_page(dirpath=dirpath, header=header,
-                              search='', body=cloud, footer=footer)
+                              search='', body=cloud, footer=footer,
+                              tree=tree)
+
+    return page
+
+
+def directory_page(tree, dirpath, directory, filters=None, suffix='',
+                   order='', links='', stream=False, static=False):
+    '''Render the page of a directory found in the du tree, keeping
+    only the children that pass filters (see request_filters), sorted
+    by order.  suffix is appended to the links of the cloud, and links
+    to the header.
+
+    With stream, directories of more than --stream_threshold children
+    are returned as a generator of chunks, so the first ones are sent
+    before the whole page is rendered.  With static, the page leaves
+    out the links and the search form that need dircloud to answer
+    them (see export_site).'''
+    if filters or order:
+        if dirpath.endswith(read_from_disk):
+            # Read from disk, not from the tree: nothing to reuse
+            directory = filter_directory(None, dirpath, directory, filters, order)
+        else:
+            directory = filter_directory(tree, dirpath, directory, filters, order)
+    entries = len(directory)
+    total_size = tree.getBranchSize(dirpath.rstrip(read_from_disk))
+    if static:
+        header = '<div class="stale_info">%s directories, %s</div>' % (entries, human_readable(total_size))
+    else:
+        header = '<div class="stale_info">%s directories, <a href="/?dircloud=statistics">%s</a>%s</div>' % (entries, human_readable(total_size), links)
+    if stream and args.stream_threshold and entries > args.stream_threshold:
+        metrics.inc('dircloud_streamed_pages_total')
+        return iter_html_page(dirpath=dirpath, header=header, search='',
+                              body=iter_cloud(dirpath, directory, suffix=suffix, static=static),
+                              footer='', tree=tree, static=static)
+    cloud = make_cloud(dirpath, directory, suffix=suffix, static=static)
+    page = make_html_page(dirpath=dirpath, header=header,
+                          search='', body=cloud, footer='',
+                          tree=tree, static=static)
+    return page
 
+
+def request_filters():
+    '''Return the size and age filters of the request, as a dict of
+    min_size (bytes) and older_than and newer_than (seconds since the
+    epoch) values'''
+    filters = {}
+    try:
+        if request.GET.get('min_size'):
+            filters['min_size'] = parse_size(request.GET.get('min_size'))
+        now = time.time()
+        for name in ('older_than', 'newer_than'):
+            if request.GET.get(name):
+                filters[name] = parse_age(request.GET.get(name), now)
+    except ValueError as e:
+        raise HTTPResponse('Wrong filter: %s' % (e), status=400)
+    return filters
+
+
+sort_orders = ('name', 'size', 'mtime')
+query_names = ('min_size', 'older_than', 'newer_than', 'sort')
+
+
+def request_order():
+    '''Return the sort order of the children asked in the request, or
+    an empty string for the order they are stored in'''
+    order = request.GET.get('sort') or ''
+    if order and not order in sort_orders:
+        raise HTTPResponse('Wrong sort order: %s' % (order), status=400)
+    return order
+
+
+def query_suffix(query=None, **changes):
+    '''Query string to keep the filters and the order when following
+    the links, with the values in changes replaced.  query defaults to
+    the one of the request.'''
+    if query is None:
+        query = request.GET
+    values = dict([(name, query.get(name)) for name in query_names])
+    values.update(changes)
+    query = ['%s=%s' % (name, values[name]) for name in query_names
+             if values[name]]
+    if query:
+        return '?' + '&'.join(query)
+    return ''
+
+
+def sort_links(query=None):
+    '''Links to the other sort orders of the current page.  query
+    defaults to the one of the request.'''
+    if query is None:
+        order = request_order()
+    else:
+        order = query.get('sort') or ''
+    links = []
+    for (name, label) in (('', 'default'), ('name', 'name'),
+                          ('size', 'largest'), ('mtime', 'newest')):
+        if name == order:
+            links.append(label)
+        else:
+            links.append('<a href="%s">%s</a>' % (query_suffix(query, sort=name) or '?', label))
+    return ', sorted by ' + ' | '.join(links)
+
+
+def matches_filters(entry, filters):
+    (name, size, mtime) = entry
+    if 'min_size' in filters and not size >= filters['min_size']:
+        return False
+    if 'older_than' in filters or 'newer_than' in filters:
+        if not isinstance(mtime, int):
+            # Without du --time there is nothing to compare
+            return False
+        if 'older_than' in filters and not mtime < filters['older_than']:
+            return False
+        if 'newer_than' in filters and not mtime >= filters['newer_than']:
+            return False
+    return True
+
+
+def filter_index(directory):
+    '''Sort the positions of the children of a directory by size and by
+    mtime, so filters become a couple of bisections.  Children without
+    a parsed timestamp are left out of the mtime index.'''
+    by_size = sorted(range(len(directory)), key=lambda i: directory[i][1])
+    by_mtime = sorted([i for i in range(len(directory)) if isinstance(directory[i][2], int)],
+                      key=lambda i: directory[i][2])
+    return {'sizes': [directory[i][1] for i in by_size],
+            'by_size': by_size,
+            'mtimes': [directory[i][2] for i in by_mtime],
+            'by_mtime': by_mtime,
+            }
+
+
+def sort_positions(tree, directory, order):
+    '''Positions of the children of directory sorted by name (with the
+    tree collation), size (largest first) or mtime (newest first, and
+    then the ones without timestamp)'''
+    positions = range(len(directory))
+    if order == 'name':
+        if tree is None:
+            return sorted(positions, key=lambda i: collation_key(directory[i][0], args.version_sort))
+        return sorted(positions, key=lambda i: tree.sortKey(directory[i][0]))
+    elif order == 'size':
+        return sorted(positions, key=lambda i: -directory[i][1])
+    elif order == 'mtime':
+        dated = [i for i in positions if isinstance(directory[i][2], int)]
+        undated = [i for i in positions if not isinstance(directory[i][2], int)]
+        return sorted(dated, key=lambda i: -directory[i][2]) + undated
+    return list(positions)
+
+
+def filter_directory(tree, dirpath, directory, filters, order=''):
+    '''Return the children of directory that pass the filters, sorted
+    by order (see sort_positions) or in their original order.
+
+    The indexes and orderings of the directories of a tree are kept in
+    its cache, so they are built once per tree and directory, and
+    switching between orders does not sort again.  Pass tree=None for
+    directories that do not come from a tree, like the ones read from
+    disk.
+    '''
+    if not (filters or order) or not directory:
+        return directory
+    filters = filters or {}
+    index = None
+    if tree is not None:
+        index = tree.cache.get(('filter_index', dirpath))
+    if index is None:
+        index = filter_index(directory)
+        if tree is not None:
+            tree.cache.set(('filter_index', dirpath), index)
+
+    selected = None
+    if 'min_size' in filters:
+        start = bisect.bisect_left(index['sizes'], filters['min_size'])
+        selected = set(index['by_size'][start:])
+    if 'older_than' in filters or 'newer_than' in filters:
+        start = 0
+        end = len(index['mtimes'])
+        if 'newer_than' in filters:
+            start = bisect.bisect_left(index['mtimes'], filters['newer_than'])
+        if 'older_than' in filters:
+            end = bisect.bisect_left(index['mtimes'], filters['older_than'])
+        by_mtime = set(index['by_mtime'][start:end])
+        if selected is None:
+            selected = by_mtime
+        else:
+            selected &= by_mtime
+
+    if order:
+        if not order in index:
+            # Shared by the readers of the tree, but they would all
+            # store the same list
+            index[order] = sort_positions(tree, directory, order)
+        positions = index[order]
+    elif selected is not None:
+        positions = sorted(selected)
+    else:
+        positions = range(len(directory))
+    if selected is None:
+        return [directory[i] for i in positions]
+    return [directory[i] for i in positions if i in selected]
+
+
+def plain_directory_page(tree, dirpath, directory=None):
+    '''Render the page of a directory without filters nor sort order,
+    the common case, and keep it with the tree.  Pages that would be
+    streamed are not kept, and None is returned for them.'''
+    page = tree.pages.get(dirpath)
+    if page is None:
+        if directory is None:
+            directory = tree.getChildren(dirpath)
+        if not directory or (args.stream_threshold and len(directory) > args.stream_threshold):
+            return None
+        page = directory_page(tree, dirpath, directory, links=sort_links({}))
+        tree.pages.set(dirpath, page)
     return page
 
 
+def record_hit(dirpath):
+    '''Count a visit to a directory page, to know which pages to warm
+    up after a reload'''
+    with page_hits_lock:
+        page_hits[dirpath] = page_hits.get(dirpath, 0) + 1
+        if len(page_hits) > 10 * max(args.warm_pages, 100):
+            # Forget the least visited half
+            for (hits, path) in sorted([(hits, path) for (path, hits) in page_hits.items()])[:len(page_hits) // 2]:
+                del page_hits[path]
+
+
+def warm_pages(tree):
+    '''Render the most visited pages and the top levels of a new tree
+    before the users ask for them (see --warm_pages and --warm_depth).
+    Gives up when a newer tree is published.'''
+    with page_hits_lock:
+        popular = sorted(page_hits, key=page_hits.get, reverse=True)[:args.warm_pages]
+    top = []
+    pending = [(sep, 0)]
+    while pending:
+        (dirpath, level) = pending.pop(0)
+        top.append(dirpath)
+        if level < args.warm_depth:
+            for child in tree.getChildren(dirpath):
+                if child[0].endswith(sep) and child[0] != sep:
+                    pending.append((child[0] if dirpath == sep else dirpath + child[0], level + 1))
+    start = time.time()
+    warmed = 0
+    for dirpath in popular + top:
+        if tree is not du:
+            break
+        if not dirpath in tree.pages:
+            if plain_directory_page(tree, dirpath) is not None:
+                warmed += 1
+    metrics.inc('dircloud_warmed_pages_total', warmed)
+    if args.verbose:
+        print('%s pages warmed up in %.2f seconds' % (warmed, time.time() - start), file=sys.stderr)
+
+
+def start_warming(tree):
+    if args.warm_pages or args.warm_depth:
+        warmer = threading.Thread(target=warm_pages, args=(tree,))
+        warmer.daemon = True
+        warmer.start()
+
+
 @route('/search')
+@profiled
 def search():
     q = str(request.GET.get('q'))
     match = request.GET.get('match')
+    with metrics.timer('dircloud_stage_duration_seconds', stage='search',
+                       search_client=args.search_client):
+        # Identical searches running at once (think of locate on a
+        # busy server) are answered by the first one
+        key = (q, match, query_suffix(), id(current_tree()) if args.search_client == 'string' else None)
+        try:
+            results = search_flight.do(key, lambda: search_results(q, match),
+                                       args.coalesce_timeout)
+        except SingleFlightTimeout:
+            raise HTTPResponse('Search still running, try again later', status=503,
+                               headers={'Retry-After': str(args.retry_after)})
+    page = make_html_page(dirpath='/', header='',
+                          search=q, body=results)
+    return page
+
+
+def search_results(q, match):
     if args.search_client == 'dicoclient':
         result = dico_define(q)
         results = ''
@@ -354,20 +2215,493 @@ def search():
         else:
             opt = ''
         cmd = '/usr/bin/locate %s %s' % (opt, q)
-        out = subprocess.getoutput(cmd)
+        out = run_command(cmd)
         results = locate2html(out)
     elif args.search_client == 'string':
+        tree = current_tree()
         if match == 'on':
             q = normalize_string(q)
-            lines = [line for line in du.getBranchNames() if normalize_string(line).count(q)]
+            lines = [line for line in tree.getBranchNames(sort=False) if normalize_string(line).count(q)]
         else:
-            lines = [line for line in du.getBranchNames() if line.count(q)]
+            lines = tree.searchNames(q)
+        filters = request_filters()
+        if filters:
+            lines = [line for line in lines
+                     if matches_filters(tree.getBranch(line) or tree.empty, filters)]
         lines.sort()
         out = '\n'.join(lines)
         results = locate2html(out)
 
-    page = make_html_page(dirpath='/', header='',
-                          search=q, body=results)
+    return results
+
+
+@route('/metrics')
+def metrics_page():
+    '''Export dircloud internals in the Prometheus text format'''
+    tree = du
+    # Not read back from the cache, that may drop it meanwhile
+    values = tree.cache.get('metrics')
+    if values is None:
+        values = tree_metrics(tree)
+        tree.cache.set('metrics', values)
+    (children, memory) = values
+    metrics.set('dircloud_tree_branches', len(tree))
+    metrics.set('dircloud_tree_children', children)
+    metrics.set('dircloud_tree_memory_bytes', memory)
+    metrics.set('dircloud_tree_mtime_seconds', tree.mtime)
+    metrics.set('dircloud_tree_packed', int(bool(tree.packed)))
+    metrics.set('dircloud_cache_entries', len(fallback_cache), cache='openfile_fallback')
+    metrics.set('dircloud_cache_entries', len(disk_cache), cache='read_from_disk')
+    response.content_type = 'text/plain; version=0.0.4'
+    return metrics.format()
+
+
+def tree_metrics(tree, sample=1000):
+    '''Return the number of children of a tree and an estimation of
+    the memory it uses, extrapolated from a sample of its branches'''
+    children = 0
+    if isinstance(tree, SqliteTree):
+        # Plus the ones of the branches modified since ingestion
+        children = tree.children
+    for parent in tree.branches:
+        branch = tree.branches[parent]
+        if isinstance(branch, list):
+            children += len(branch)
+        else:
+            children += tree.packed.children_offsets[branch + 1] - tree.packed.children_offsets[branch]
+
+    sampled = 0
+    memory = 0
+    for parent in tree.branches:
+        if sampled >= sample:
+            break
+        sampled += 1
+        memory += branch_memory(parent, tree.branches[parent])
+    if sampled:
+        memory = memory * len(tree.branches) // sampled
+    memory += sys.getsizeof(tree.branches)
+    memory += packed_memory(tree)
+
+    return (children, memory)
+
+
+def branch_memory(parent, branch):
+    '''Bytes used by the key and the children list of a branch (only
+    the index of the branch, if packed)'''
+    memory = sys.getsizeof(parent) + sys.getsizeof(branch)
+    if isinstance(branch, list):
+        for child in branch:
+            memory += sys.getsizeof(child)
+            memory += sum([sys.getsizeof(value) for value in child])
+    return memory
+
+
+def packed_memory(tree):
+    '''Bytes used by the buffers of a packed tree'''
+    if not tree.packed:
+        return 0
+    packed = tree.packed
+    memory = len(packed.names) + len(packed.mtimes)
+    for buffer in (packed.sizes, packed.children_offsets,
+                   packed.names_offsets, packed.mtimes_offsets):
+        memory += buffer.itemsize * len(buffer)
+    return memory
+
+
+def memory_by_branch(tree, sample=10000):
+    '''Return a dict with the number of children and the estimated
+    bytes of each top level branch of the tree.  The bytes of one
+    branch out of every len(tree.branches) / sample are measured and
+    extrapolated, and the packed buffers are shared out by number of
+    children.  Branches kept on disk (--tree_db, --max_memory_depth)
+    are not counted.'''
+    step = max(1, len(tree.branches) // sample)
+    tops = {}
+    total = 0
+    for (i, parent) in enumerate(tree.branches):
+        branch = tree.branches[parent]
+        top = parent.strip(sep).split(sep)[0] + sep
+        if isinstance(branch, list):
+            children = len(branch)
+        else:
+            children = tree.packed.children_offsets[branch + 1] - tree.packed.children_offsets[branch]
+        total += children
+        values = tops.setdefault(top, [0, 0])
+        values[0] += children
+        if i % step == 0:
+            values[1] += branch_memory(parent, branch) * step
+    shared = packed_memory(tree)
+    if shared and total:
+        for values in tops.values():
+            values[1] += shared * values[0] // total
+    return dict([(top, tuple(values)) for (top, values) in tops.items()])
+
+
+def tree_memory(tree):
+    '''memory_by_branch() of tree, cached in it'''
+    by_branch = tree.cache.get('memory')
+    if by_branch is None:
+        by_branch = memory_by_branch(tree)
+        tree.cache.set('memory', by_branch)
+    return by_branch
+
+
+def record_memory(tree):
+    '''Record a newly loaded tree, to be compared in /memory with the
+    one it replaces, and with itself as it grows
+    (--update_du_with_read_from_disk).  Accounting its memory walks
+    the whole tree, so it is left to /memory, while the tree is still
+    around.  With --tracemalloc it is done right after the load,
+    together with a snapshot of the allocations.'''
+    record = {'time': time.time(),
+              'filename': tree.filename,
+              'branches': len(tree),
+              'tree': weakref.ref(tree),
+              }
+    if args.tracemalloc and tracemalloc.is_tracing():
+        gc.collect()
+        record['by_branch'] = tree_memory(tree)
+        record['traced'] = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        record['snapshot'] = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    with memory_lock:
+        # Only the last two, as snapshots are big
+        memory_records[:] = memory_records[-1:] + [record]
+
+
+def peak_rss():
+    '''Peak resident memory of the process, in bytes, or None where
+    unknown'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+@route('/memory')
+def memory_page():
+    '''Memory used by the tree, total and by top level branch, and its
+    changes since it was loaded and since the previous load.  Only
+    for admins (see --admin_key).'''
+    if not is_admin():
+        raise HTTPResponse('Forbidden', status=403)
+    tree = du
+    try:
+        n = int(request.GET.get('n') or 20)
+    except ValueError:
+        raise HTTPResponse('Wrong number: %s' % (request.GET.get('n')), status=400)
+    by_branch = tree_memory(tree)
+    with memory_lock:
+        records = list(memory_records)
+    for record in records:
+        loaded = record['tree']()
+        if 'by_branch' not in record and loaded is not None:
+            record['by_branch'] = tree_memory(loaded)
+    children = sum([values[0] for values in by_branch.values()])
+    memory = sum([values[1] for values in by_branch.values()])
+
+    def per_entry(values):
+        return '%s in %s entries, %s bytes per entry' % (human_readable(values[1]),
+                                                        thousands_separator(values[0]),
+                                                        values[1] // values[0] if values[0] else 0)
+
+    body = []
+    body.append('<h3>Tree</h3>')
+    body.append(' <ul>')
+    body.append('  <li>%s branches, %s</li>' % (thousands_separator(len(tree)),
+                                                 per_entry((children, memory))))
+    if peak_rss() is not None:
+        body.append('  <li>%s peak resident memory of the process</li>' % (human_readable(peak_rss())))
+    body.append(' </ul>')
+    body.append('<h3>By top level branch</h3>')
+    body.append(' <ol>')
+    for (top, values) in sorted(by_branch.items(), key=lambda item: item[1][1], reverse=True)[:n]:
+        body.append('  <li><a href="%s">%s</a> %s</li>' % (minimal_url_quote(sep + top.lstrip(sep)), displayable(top),
+                                                            per_entry(values)))
+    body.append(' </ol>')
+
+    if records and 'by_branch' in records[-1]:
+        body.append('<h3>Changes</h3>')
+        body.append(' <ul>')
+        loaded = records[-1]
+        (children_then, memory_then) = [sum(column) for column in zip(*loaded['by_branch'].values())] or (0, 0)
+        body.append('  <li>since loaded at %s: %+d entries, %+d bytes</li>' % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(loaded['time'])),
+            children - children_then, memory - memory_then))
+        if len(records) > 1 and 'by_branch' in records[0]:
+            previous = records[0]
+            (children_before, memory_before) = [sum(column) for column in zip(*previous['by_branch'].values())] or (0, 0)
+            body.append('  <li>since the previous load (%s): %+d entries, %+d bytes</li>' % (
+                displayable(previous['filename']), children_then - children_before,
+                memory_then - memory_before))
+        if 'traced' in loaded:
+            body.append('  <li>%s traced by tracemalloc after the load, %s at the peak</li>' % (
+                human_readable(loaded['traced'][0]), human_readable(loaded['traced'][1])))
+        body.append(' </ul>')
+        if 'snapshot' in loaded:
+            body.append('<h3>Top allocation sites after the load</h3>')
+            body.append(' <ol>')
+            for statistic in loaded['snapshot'].statistics('lineno')[:n]:
+                body.append('  <li>%s</li>' % (displayable(str(statistic))))
+            body.append(' </ol>')
+            if len(records) > 1 and 'snapshot' in records[0]:
+                body.append('<h3>Allocation changes since the previous load</h3>')
+                body.append(' <ol>')
+                for statistic in loaded['snapshot'].compare_to(records[0]['snapshot'], 'lineno')[:n]:
+                    body.append('  <li>%s</li>' % (displayable(str(statistic))))
+                body.append(' </ol>')
+
+    header = '<div class="stale_info">Memory of %s</div>' % (displayable(tree.filename))
+    page = make_html_page(dirpath='', header=header,
+                          search='', body='\n'.join(body), footer='',
+                          tree=tree)
+    return page
+
+
+def push_largest(heap, n, size, path):
+    '''Keep the n largest (size, path) pairs in heap'''
+    if len(heap) < n:
+        heapq.heappush(heap, (size, path))
+    elif (size, path) > heap[0]:
+        heapq.heappushpop(heap, (size, path))
+
+
+def find_largest(tree, branch=''):
+    '''Return the args.largest (exclusive size, path) pairs of tree
+    under branch, largest first.
+
+    du sizes include the children ones, so the exclusive size of an
+    entry is its size minus the sum of the sizes of its children.
+    Entries are ranked in two passes over the branches: the first one
+    sums the sizes of the children of each branch, and the second one
+    subtracts them.
+    '''
+    children_sizes = {}
+    for (parent, children) in tree.iterBranches(branch):
+        children_sizes[parent.strip(sep)] = sum([child[1] for child in children])
+    largest = []
+    for (parent, children) in tree.iterBranches(branch):
+        for child in children:
+            path = (parent + child[0]).strip(sep)
+            if not path:
+                # The root of a du of /, no entry of its own
+                continue
+            exclusive = child[1] - children_sizes.get(path, 0)
+            push_largest(largest, args.largest, exclusive, path)
+    return sorted(largest, reverse=True)
+
+
+def tree_largest(tree, branch, n):
+    '''The n largest entries under branch, cached in the tree.  The
+    whole tree ones are usually found at load time (see read_du_file).'''
+    branch = branch.strip(sep)
+    everywhere = tree.cache.get(('largest', ''))
+    if branch and everywhere is not None:
+        # When the largest entries of the whole tree include enough
+        # ones under branch, these are the largest ones of branch too
+        largest = [entry for entry in everywhere
+                   if entry[1].startswith(branch + sep)]
+        if len(largest) >= n or len(everywhere) < args.largest:
+            return largest[:n]
+    largest = tree.cache.get(('largest', branch))
+    if largest is None:
+        if branch:
+            largest = find_largest(tree, branch + sep)
+        else:
+            largest = find_largest(tree)
+        tree.cache.set(('largest', branch), largest)
+    return largest[:n]
+
+
+def largest_page(tree, dirpath, n):
+    '''List the n largest entries under dirpath, by exclusive size'''
+    largest = tree_largest(tree, dirpath.rstrip(read_from_disk), n)
+    body = []
+    body.append(' <ol>')
+    for (size, path) in largest:
+        href = sep + path + sep
+        body.append('  <li><a href="%s">%s</a> %s</li>' % (html_escape(minimal_url_quote(href)),
+                                                            html_escape(displayable(href)),
+                                                            human_readable(size)))
+    body.append(' </ol>')
+    header = '<div class="stale_info">%s largest entries by their own size</div>' % (len(largest))
+    page = make_html_page(dirpath=dirpath, header=header,
+                          search='', body='\n'.join(body), footer='',
+                          tree=tree)
+    return page
+
+
+size_buckets = (4 * 1024, 1024 ** 2, 100 * 1024 ** 2, 1024 ** 3)
+age_buckets = (7 * 24 * 3600, 30 * 24 * 3600, 365 * 24 * 3600, 5 * 365 * 24 * 3600)
+
+
+def type_columns(tree):
+    '''Return the extension names and the columns of extension codes,
+    sizes and mtimes (-1 when unknown) of the leaves of tree, with the
+    sorted branch names and the offset of the first leaf of each one
+    (and the end of the columns).  They are built once and cached in
+    the tree; the leaves of a subtree are the slice found by
+    type_slice().
+
+    Leaves are the entries without children of their own: files, when
+    the tree comes from du -a or was updated with
+    --update_du_with_read_from_disk, and empty directories.  Their
+    sizes are their own ones, so they add up without counting twice.
+    '''
+    columns = tree.cache.get('type_columns')
+    if columns is not None:
+        return columns
+    # Sorted, so that the branches of any subtree are consecutive
+    branches = sorted(tree.iterBranches(), key=lambda branch: branch[0])
+    parents = set([parent.strip(sep) for (parent, children) in branches])
+    extensions = {}
+    codes = array('l')
+    sizes = array('q')
+    mtimes = array('q')
+    offsets = array('l')
+    for (parent, children) in branches:
+        offsets.append(len(codes))
+        for child in children:
+            name = child[0]
+            if (parent + name).strip(sep) in parents:
+                continue
+            extension = os.path.splitext(name.rstrip(sep))[1].lower()
+            code = extensions.get(extension)
+            if code is None:
+                code = extensions[extension] = len(extensions)
+            codes.append(code)
+            sizes.append(child[1])
+            mtimes.append(child[2] if isinstance(child[2], int) else -1)
+    offsets.append(len(codes))
+    names = [''] * len(extensions)
+    for (extension, code) in extensions.items():
+        names[code] = extension
+    columns = (names, codes, sizes, mtimes,
+               [parent for (parent, children) in branches], offsets)
+    tree.cache.set('type_columns', columns)
+    return columns
+
+
+def type_slice(columns, branch):
+    '''Return the (start, end) range of the leaves under branch (no
+    trailing separator, '' for the whole tree) in type_columns()'''
+    (names, codes, sizes, mtimes, parents, offsets) = columns
+    if not branch:
+        return (0, len(codes))
+    # The branch names under branch + sep are the ones between it and
+    # the same name followed by the character after sep
+    start = bisect.bisect_left(parents, branch + sep)
+    end = bisect.bisect_left(parents, branch + chr(ord(sep) + 1), start)
+    return (offsets[start], offsets[end])
+
+
+def group_by(codes, sizes, groups):
+    '''Return the counts and the sums of sizes of each of groups
+    codes, like numpy.bincount, with or without NumPy'''
+    if numpy is not None:
+        counts = numpy.bincount(codes, minlength=groups)
+        sums = numpy.bincount(codes, weights=sizes, minlength=groups)
+        return ([int(count) for count in counts], [int(total) for total in sums])
+    counts = [0] * groups
+    sums = [0] * groups
+    for (code, size) in zip(codes, sizes):
+        counts[code] += 1
+        sums[code] += size
+    return (counts, sums)
+
+
+def bucket_codes(values, buckets, unknown=None):
+    '''Return the bucket of each value: 0 for the values below
+    buckets[0], len(buckets) for the ones above the last bound, and
+    len(buckets) + 1 for the unknown ones (negative, when unknown is
+    given)'''
+    if numpy is not None:
+        values = numpy.asarray(values)
+        codes = numpy.searchsorted(buckets, values, side='right')
+        if unknown is not None:
+            codes[unknown] = len(buckets) + 1
+        return codes
+    codes = array('l', [bisect.bisect_right(buckets, value) for value in values])
+    if unknown is not None:
+        for i in unknown:
+            codes[i] = len(buckets) + 1
+    return codes
+
+
+def type_statistics(tree, branch=''):
+    '''Bytes and counts of the leaves under branch by extension, size
+    bucket and age bucket, cached in the tree'''
+    branch = branch.strip(sep)
+    statistics = tree.cache.get(('types', branch))
+    if statistics is not None:
+        return statistics
+    columns = type_columns(tree)
+    (start, end) = type_slice(columns, branch)
+    names = columns[0]
+    (codes, sizes, mtimes) = [column[start:end] for column in columns[1:4]]
+    now = int(time.time())
+    if numpy is not None:
+        codes = numpy.frombuffer(codes, dtype=numpy.dtype('i%d' % (codes.itemsize)))
+        sizes = numpy.frombuffer(sizes, dtype=numpy.int64)
+        mtimes = numpy.frombuffer(mtimes, dtype=numpy.int64)
+        ages = now - mtimes
+        unknown = mtimes < 0
+    else:
+        ages = [now - mtime for mtime in mtimes]
+        unknown = [i for (i, mtime) in enumerate(mtimes) if mtime < 0]
+    statistics = {'entries': len(sizes)}
+    (counts, sums) = group_by(codes, sizes, len(names))
+    # The names are the ones of the whole tree
+    statistics['extensions'] = sorted([extension for extension in zip(sums, counts, names)
+                                       if extension[1]], reverse=True)
+    (counts, sums) = group_by(bucket_codes(sizes, size_buckets),
+                              sizes, len(size_buckets) + 1)
+    statistics['sizes'] = list(zip(sums, counts))
+    (counts, sums) = group_by(bucket_codes(ages, age_buckets, unknown),
+                              sizes, len(age_buckets) + 2)
+    statistics['ages'] = list(zip(sums, counts))
+    tree.cache.set(('types', branch), statistics)
+    return statistics
+
+
+def types_page(tree, dirpath, n):
+    '''Break down the bytes and the number of leaves (see type_columns)
+    under dirpath by extension (the n largest ones), size and age'''
+    statistics = type_statistics(tree, dirpath.rstrip(read_from_disk))
+    body = []
+    body.append('<h3>By extension</h3>')
+    body.append(' <ol>')
+    for (total, count, extension) in statistics['extensions'][:n]:
+        body.append('  <li>%s %s in %s entries</li>' % (displayable(extension or '(none)'),
+                                                         human_readable(total),
+                                                         thousands_separator(count)))
+    body.append(' </ol>')
+    body.append('<h3>By size</h3>')
+    body.append(' <ul>')
+    labels = ['up to %s' % (human_readable(size_buckets[0]))]
+    labels += ['%s to %s' % (human_readable(low), human_readable(high))
+               for (low, high) in zip(size_buckets, size_buckets[1:])]
+    labels += ['over %s' % (human_readable(size_buckets[-1]))]
+    for (label, (total, count)) in zip(labels, statistics['sizes']):
+        body.append('  <li>%s: %s in %s entries</li>' % (label, human_readable(total),
+                                                          thousands_separator(count)))
+    body.append(' </ul>')
+    body.append('<h3>By age</h3>')
+    body.append(' <ul>')
+    labels = ['last week', 'last month', 'last year', 'last 5 years', 'older', 'unknown (no du --time)']
+    for (label, (total, count)) in zip(labels, statistics['ages']):
+        if count:
+            body.append('  <li>%s: %s in %s entries</li>' % (label, human_readable(total),
+                                                              thousands_separator(count)))
+    body.append(' </ul>')
+    header = '<div class="stale_info">%s files and empty directories</div>' % (thousands_separator(statistics['entries']))
+    page = make_html_page(dirpath=dirpath, header=header,
+                          search='', body='\n'.join(body), footer='',
+                          tree=tree)
     return page
 
 
@@ -398,7 +2732,7 @@ def credits_page():
     if args.search_client == 'dicoclient':
         body.append('  <li><a href="http://www.dict.org/">dict</a> for a wonderful indexing engine.</li>')
     elif args.search_client == 'locate':
-        out = subprocess.getoutput('/usr/bin/locate --version')
+        out = run_command('/usr/bin/locate --version')
         which_locate = out.split()[0]
         if which_locate == 'mlocate':
             url = "https://fedorahosted.org/mlocate/"
@@ -428,10 +2762,10 @@ def statistics_page():
         pass
     elif args.search_client == 'dicoclient':
         try:
-            out = dico.show_server()
+            out = get_dico().show_server()
         except DicoNotConnectedError:
-            dico.open('localhost')
-            out = dico.show_server()
+            get_dico().open('localhost')
+            out = get_dico().show_server()
         lines = out['desc'].split('\n')
         body.append(lines.pop(0))
         body.append('<br />')
@@ -447,7 +2781,7 @@ def statistics_page():
         body.append(' </ul>')
     elif args.search_client == 'locate':
         cmd = '/usr/bin/locate --statistics'
-        out = subprocess.getoutput(cmd)
+        out = run_command(cmd)
         lines = out.split('\n')
         body.append(lines.pop(0))
         body.append(' <ul>')
@@ -472,7 +2806,9 @@ def statistics_page():
     body.append('<p />')
 
     filenames = args.filename
-    if len(filenames) > 1:
+    if args.federate:
+        body.append('%s hosts' % (len(filenames)))
+    elif len(filenames) > 1:
         # When dircloud whas called with a list of comma-separated
         # input files, this form allows the end user to change fie.
         select = []
@@ -494,6 +2830,7 @@ def statistics_page():
                 time.strftime('%Y-%m-%d %H:%M', time.localtime(du.mtime))
                 ))
     body.append('  <li>%s directories</li>' % (thousands_separator(len(du))))
+    body.append('  <li><a href="/?dircloud=types">by extension, size and age</a></li>')
     body.append(' </ul>')
 
     space = df.getChildren('/')
@@ -539,86 +2876,689 @@ def switch_file():
     somewhat hasckish function puts the selected file first and forces
     a change of input file.
     '''
-    global du
     filename = str(request.GET.get('filename'))
-    filenames = args.filename
+    # Build a new list instead of reordering it in place, as other
+    # threads may be reading it
+    filenames = list(args.filename)
     filenames.remove(filename)
     filenames.insert(0, filename)
     args.filename = filenames
-    du = read_du_file_maybe(args.filename)
+    tree = read_du_file_maybe(args.filename, wait=False)
     redirect('/')
-    return du
+    return tree
 
 
-def read_du_file_maybe(filenames):
-    '''Read a du tree from disk and store as Tree object'''
-    global du
+def current_tree():
+    '''Return the du tree to answer the current request with.
+
+    (Re)loads happen in the background.  Until the first tree is
+    ready, requests get a 503 loading page instead of waiting for it.
+    '''
+    tree = read_du_file_maybe(args.filename, wait=False)
+    if not tree and (progress['error'] or (loader and loader.is_alive())):
+        raise HTTPResponse(loading_page(), status=503,
+                           headers={'Retry-After': str(args.retry_after)})
+    return tree
+
+
+def read_du_file_maybe(filenames, wait=True):
+    '''Read a du tree from disk and store as Tree object
+
+    The new tree is built aside and published when complete.  Only one
+    thread reads the file; the others keep using the previous tree
+    meanwhile, and only wait when there is none yet.  With wait=False,
+    the file is read by a background thread and the current tree,
+    maybe still empty, is returned at once.
+    '''
+    global du, loader
     filename = filenames[0]
     mtime = os.path.getmtime(filename)
-    if not du or mtime > du.atime or filename != du.filename:
-        du = Tree(filename=filename, mtime=mtime, atime=time.time(), version_sort=args.version_sort)
+    if args.federate:
+        changed = federation_changed(filenames)
+    else:
+        changed = not du or mtime > du.atime or filename != du.filename
+    if changed:
+        if not wait:
+            with loader_lock:
+                if loader is None or not loader.is_alive():
+                    loader = threading.Thread(target=load_du_file,
+                                              args=(list(filenames),))
+                    loader.daemon = True
+                    loader.start()
+            return du
+        if du:
+            if not du_lock.acquire(False):
+                return du
+        else:
+            du_lock.acquire()
+        loaded = None
+        try:
+            # Somebody may have done the job while we were waiting
+            if args.federate:
+                if federation_changed(filenames):
+                    du = loaded = read_federation(filenames)
+            elif not du or mtime > du.atime or filename != du.filename:
+                du = loaded = read_du_file(filename, mtime)
+        finally:
+            du_lock.release()
+        if loaded is not None:
+            record_memory(loaded)
+    return du
+
+
+def load_du_file(filenames):
+    '''Background loader thread.  Errors are kept in progress, to
+    be shown to the users instead of a never ending loading page.'''
+    try:
+        tree = read_du_file_maybe(filenames)
+    except Exception as e:
+        progress['error'] = '%s: %s' % (e.__class__.__name__, e)
+        print('Cannot read %s: %s' % (filenames[0], progress['error']), file=sys.stderr)
+    else:
+        start_warming(tree)
+
+
+def read_du_file(filename, mtime, pack=True):
+    '''Parse a du output file into a new Tree object.  Parsing
+    progress, in bytes, is kept in the progress dict.'''
+    start = time.time()
+    progress.update({'filename': filename, 'bytes_read': 0,
+                     'bytes_total': os.path.getsize(filename),
+                     'start': start, 'end': 0, 'error': ''})
+    if args.tree_db:
+        tree = SqliteTree.open(args.tree_db, filename, mtime,
+                               version_sort=args.version_sort)
+        if tree:
+            progress.update({'bytes_read': progress['bytes_total'], 'end': time.time()})
+            return tree
+    f = open(filename, 'rb')
+    tree = parse_du(iter_records(iter(lambda: f.read(1 << 20), b'')),
+                    filename, mtime, pack)
+    f.close()
+    return tree
+
+
+def parse_du(batches, filename, mtime, pack=True):
+    '''Parse a du output into a new Tree object, stored as asked in
+    the command line options, and for the du file filename.  The
+    output comes as (bytes, records) batches (see iter_records).
+    Progress is kept in the progress dict.'''
+    start = progress['start']
+    if args.tree_db:
+        tree = SqliteTree(args.tree_db, filename=filename, mtime=mtime,
+                          atime=time.time(), version_sort=args.version_sort)
+        tree.begin()
+    else:
+        tree = Tree(filename=filename, mtime=mtime, atime=time.time(), version_sort=args.version_sort)
+    try:
+        if args.max_memory_depth and not args.tree_db:
+            tree.deep = DeepBranches(deep_index_filename(filename),
+                                     args.max_memory_depth, args.deep_cache_size)
         du_units = args.du_units
-        f = open(filename)
-        for line in f:
-            fields = line.split('\t')
-            size = int(fields[0]) * du_units
-            name = fields[-1].lstrip('./').replace('\n', sep)
-            if len(fields) == 3:
-                mtime = fields[1]	# du --time parameter
+        timestamps = {}
+        with_time = None
+        # Largest entries by exclusive size.  du writes the children before
+        # their parent, so when a directory comes its children sizes are
+        # already summed up in children_sizes, and can be popped.
+        largest = []
+        children_sizes = {}
+        bytes_read = 0
+        parsed = 0
+        for (length, records) in batches:
+            bytes_read += length
+            progress['bytes_read'] = bytes_read
+            for record in records:
+                if not b'\t' in record or b'\0' in record:
+                    # Empty, or the tail of a file name with a newline in
+                    # a du output without -0
+                    continue
+                (size, path) = record.split(b'\t', 1)
+                size = int(size) * du_units
+                if with_time is None:
+                    # du --time adds a timestamp field.  Decide once, as
+                    # file names may have tabs too, and on a sample, as
+                    # the first one may look like a timestamp too.
+                    sample = [line.split(b'\t', 1)[1] for line in records[:100] if b'\t' in line]
+                    with_time = all([du_time_re.match(line) for line in sample])
+                parsed += 1
+                if with_time:
+                    (mtime, path) = path.split(b'\t', 1)
+                    if not mtime in timestamps:
+                        # Only a few distinct minutes in a du output
+                        timestamps[mtime] = parse_timestamp(mtime.decode('ascii', 'replace'))
+                    mtime = timestamps[mtime]
+                else:
+                    mtime = ''
+                name = path.decode('utf-8', name_errors).lstrip('./') + sep
+                values = [size, mtime]
+                tree.addBranch(name, values, sort=False)
+                path = name.rstrip(sep)
+                exclusive = size - children_sizes.pop(path, 0)
+                parent = path.rpartition(sep)[0]
+                children_sizes[parent] = children_sizes.get(parent, 0) + size
+                if path:
+                    # Not the root of a du of /
+                    push_largest(largest, args.largest, exclusive, path)
+        if bytes_read and not parsed:
+            raise ValueError('no du records found')
+        tree.sortBranches()
+        if len(children_sizes) == 1:
+            # Only the parent of the root is left, as expected in du order
+            tree.cache.set(('largest', ''), sorted(largest, reverse=True))
+        if tree.deep is not None:
+            tree.deep.finish()
+        if args.tree_db:
+            tree.finish()
+    except:
+        # Do not leave the half built indexes behind
+        if tree.deep is not None:
+            tree.deep.abort()
+        if args.tree_db:
+            tree.abort()
+        raise
+    if args.pack_tree and pack:
+        tree.pack()
+    progress['bytes_read'] = max(bytes_read, progress['bytes_total'])
+    progress['end'] = time.time()
+    metrics.set('dircloud_du_parse_seconds', time.time() - start)
+    metrics.inc('dircloud_du_reloads_total')
+    return tree
+
+
+@route('/ingest', method='POST')
+def ingest():
+    '''Parse a du output sent as the request body, maybe gzipped or
+    chunked, as it arrives, and publish it as the new tree.  With
+    --federate, the host query parameter tells which host tree is
+    replaced.
+
+    The tree stays until the du file is modified, that is read again
+    as usual.  Only admins (see --admin_key) can ingest.
+    '''
+    global du
+    if not is_admin():
+        raise HTTPResponse('Forbidden', status=403)
+    if args.federate:
+        filenames = dict([(host_name(filename), filename) for filename in args.filename])
+        filename = filenames.get(request.GET.get('host'))
+        if not filename:
+            raise HTTPResponse('Unknown host: %s' % (request.GET.get('host')), status=400)
+    else:
+        filename = args.filename[0]
+    if not ingest_lock.acquire(False):
+        raise HTTPResponse('Another du output is being ingested', status=409)
+    try:
+        start = time.time()
+        progress.update({'filename': 'POST /ingest', 'bytes_read': 0,
+                         'bytes_total': int(request.environ.get('CONTENT_LENGTH') or 0),
+                         'start': start, 'end': 0, 'error': ''})
+        batches = iter_records(decompress_chunks(iter_request_body(request.environ)))
+        try:
+            tree = parse_du(batches, filename, start, pack=not args.federate)
+        except (ValueError, IndexError, zlib.error) as e:
+            raise HTTPResponse('Wrong du output: %s' % (e), status=400)
+        bytes_read = progress['bytes_read']
+        if not bytes_read:
+            raise HTTPResponse('Empty du output', status=400)
+        with du_lock:
+            if args.federate:
+                hosts[filename] = {'mtime': os.path.getmtime(filename),
+                                   'branches': tree.branches}
+                du = read_federation(args.filename)
             else:
-                mtime = ''
-            values = [size, mtime]
-            du.addBranch(name, values)
-        f.close()
-    return du
+                du = tree
+        record_memory(du)
+        start_warming(du)
+    finally:
+        progress['end'] = progress['end'] or time.time()
+        ingest_lock.release()
+    return {'branches': len(tree),
+            'bytes_read': bytes_read,
+            'seconds': time.time() - start,
+            }
+
+
+def iter_request_body(environ, bufsize=65536):
+    '''Generate the raw body of a request as it arrives, undoing the
+    chunked transfer encoding if needed'''
+    stream = environ['wsgi.input']
+    if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+        while True:
+            header = stream.readline(1024)
+            size = int(header.split(b';')[0].strip() or b'0', 16)
+            if not size:
+                # Skip the trailers, if any
+                while stream.readline(1024).strip():
+                    pass
+                return
+            while size:
+                chunk = stream.read(min(bufsize, size))
+                if not chunk:
+                    raise ValueError('truncated request body')
+                size -= len(chunk)
+                yield chunk
+            stream.read(2)
+    else:
+        size = int(environ.get('CONTENT_LENGTH') or 0)
+        while size > 0:
+            chunk = stream.read(min(bufsize, size))
+            if not chunk:
+                raise ValueError('truncated request body')
+            size -= len(chunk)
+            yield chunk
+
+
+def decompress_chunks(chunks):
+    '''Gunzip chunks on the fly if they look gzipped'''
+    decompressor = None
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if decompressor is None:
+            if chunk.startswith(b'\x1f\x8b'):
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                decompressor = False
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        yield chunk
+    if decompressor:
+        yield decompressor.flush()
+
+
+def iter_records(chunks):
+    '''Split a stream of byte chunks in du records, and generate them
+    in (bytes, records) batches, one per chunk.  Records end with a
+    newline, or with a NUL in du -0 outputs, that are told apart by
+    the first terminator found.  Until then, chunks only add to the
+    pending record, and their batches are empty.'''
+    pending = b''
+    terminator = None
+    for chunk in chunks:
+        if not chunk:
+            # Gunzipping often gives some of them
+            continue
+        length = len(chunk)
+        if terminator is None:
+            pending += chunk
+            if b'\0' in pending:
+                terminator = b'\0'
+            elif b'\n' in pending:
+                terminator = b'\n'
+            else:
+                # Still in the first record, maybe of a du -0 output
+                yield (length, [])
+                continue
+            chunk = b''
+        records = (pending + chunk).split(terminator)
+        pending = records.pop()
+        yield (length, records)
+    if pending:
+        yield (0, [pending])
+
+
+def host_name(filename):
+    '''Name of the host of a du file in a federation: its basename
+    without extension, so web1.du is mounted as web1/'''
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def federation_changed(filenames):
+    '''Whether the set of du files of the federation, or any of them,
+    changed since they were read'''
+    if not du or set(filenames) != set(hosts):
+        return True
+    for filename in filenames:
+        if os.path.getmtime(filename) != hosts[filename]['mtime']:
+            return True
+    return False
+
+
+def read_host_file(filename):
+    '''Parse the du file of a host, maybe in a worker process, and
+    return its mtime and branches'''
+    mtime = os.path.getmtime(filename)
+    tree = read_du_file(filename, mtime, pack=False)
+    return (filename, mtime, tree.branches)
+
+
+def read_federation(filenames):
+    '''Build a tree whose root lists the hosts of the du files, each
+    one with its own tree mounted under it.
+
+    Only the files that changed since the last time are parsed, by a
+    pool of worker processes; the branches of the other hosts are
+    reused.  The workers are not forked from the server, whose threads
+    may hold locks at that moment, but started by a clean forkserver
+    (or spawned), and configured again with the same arguments.  The
+    new tree shares the branch lists with the hosts cache, and copies
+    them before modifying them like any copy of a tree.
+    '''
+    start = time.time()
+    stale = [filename for filename in filenames
+             if not filename in hosts or os.path.getmtime(filename) != hosts[filename]['mtime']]
+    bytes_total = sum([os.path.getsize(filename) for filename in stale])
+    progress.update({'filename': '%s hosts' % (len(stale)), 'bytes_read': 0,
+                     'bytes_total': bytes_total,
+                     'start': start, 'end': 0, 'error': ''})
+    bytes_read = 0
+    if args.federate_processes != 1 and len(stale) > 1 and hasattr(multiprocessing, 'get_context'):
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        else:
+            context = multiprocessing.get_context('spawn')
+        pool = context.Pool(args.federate_processes or None,
+                            initializer=configure, initargs=(args.argv,))
+        results = pool.imap_unordered(read_host_file, stale)
+    else:
+        pool = None
+        results = map(read_host_file, stale)
+    for (filename, mtime, branches) in results:
+        hosts[filename] = {'mtime': mtime, 'branches': branches}
+        bytes_read += os.path.getsize(filename)
+        progress.update({'filename': '%s hosts' % (len(stale)), 'bytes_read': bytes_read,
+                         'bytes_total': bytes_total})
+    if pool:
+        pool.close()
+        pool.join()
+    for filename in list(hosts):
+        if not filename in filenames:
+            del hosts[filename]
+
+    tree = Tree(filename=filenames[0], atime=time.time(), version_sort=args.version_sort)
+    root = []
+    for filename in filenames:
+        host = host_name(filename) + sep
+        branches = hosts[filename]['branches']
+        for parent in branches:
+            if parent:
+                tree.branches[host + parent.lstrip(sep)] = branches[parent]
+        if '' in branches:
+            # du of /: its own line has the total
+            (size, mtime) = branches[''][0][1:]
+        else:
+            children = branches.get(sep, [])
+            size = sum([child[1] for child in children])
+            mtimes = [child[2] for child in children if isinstance(child[2], int)]
+            mtime = max(mtimes) if mtimes else ''
+        root.append([host, size, mtime])
+        tree.mtime = max(tree.mtime, hosts[filename]['mtime'])
+    root.sort()
+    tree.branches[sep] = root
+    mtimes = [child[2] for child in root if isinstance(child[2], int)]
+    tree.branches[''] = [[sep, sum([child[1] for child in root]),
+                          max(mtimes) if mtimes else '']]
+    # The children lists are the ones of the hosts
+    tree.owned = set()
+    if args.pack_tree:
+        tree.pack()
+    progress['bytes_read'] = progress['bytes_total']
+    progress['end'] = time.time()
+    metrics.set('dircloud_du_parse_seconds', time.time() - start)
+    metrics.inc('dircloud_du_reloads_total')
+    return tree
+
+
+def deep_index_filename(filename):
+    '''Where to keep the on disk index of the deep branches of a du file'''
+    if args.deep_index:
+        return args.deep_index
+    basename = os.path.basename(filename)
+    return os.path.join(tempfile.gettempdir(), 'dircloud-%s.sqlite' % (basename))
+
+
+du_time_re = re.compile(b'[0-9]{4}-[0-9]{2}-[0-9]{2}[^\t]*\t')
+surrogate_re = re.compile(u'[\udc80-\udcff]')
+timestamp_re = re.compile('([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):([0-9]{2})$')
+
+
+def parse_timestamp(value):
+    '''Turn a du --time timestamp into seconds since the epoch.  Values
+    that do not look like dates (arbitrary trees may keep keys there)
+    are returned unchanged.'''
+    match = timestamp_re.match(value)
+    if match:
+        # The du default format, without the cost of strptime
+        fields = [int(field) for field in match.groups()]
+        return int(time.mktime((fields[0], fields[1], fields[2],
+                                fields[3], fields[4], 0, 0, 0, -1)))
+    for format in ('%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(value, format)))
+        except ValueError:
+            pass
+    return value
+
+
+def format_timestamp(value):
+    if isinstance(value, int):
+        return time.strftime('%Y-%m-%d %H:%M', time.localtime(value))
+    return value
+
+
+def loading_page():
+    head = html_head(title='Loading', dirpath=args.host, breadcrumb=args.host)
+    head = head.replace(' <head>\n', ' <head>\n  <meta http-equiv="refresh" content="%s">\n' % (args.retry_after), 1)
+
+    body = []
+    body.append('<p />')
+    if progress['error']:
+        body.append('Cannot read %s: %s' % (progress['filename'], progress['error']))
+    else:
+        body.append('Loading %s, %s%% of %s read.  Please wait...' % (
+            progress['filename'], loading_percent(),
+            human_readable(progress['bytes_total'])))
+    body.append('<p />')
+
+    footer = '\n</body>\n\n</html>\n'
+
+    page = head + '\n'.join(body) + footer
+    return page
+
+
+def loading_percent():
+    if not progress['bytes_total']:
+        return 0
+    return int(100 * progress['bytes_read'] / progress['bytes_total'])
+
+
+@route('/status')
+def status():
+    '''Loading status, for health checks: 503 until the first tree
+    is ready, 200 afterwards, even while reloading'''
+    tree = read_du_file_maybe(args.filename, wait=False)
+    loading = bool(loader and loader.is_alive())
+    if progress['error'] and not tree:
+        state = 'error'
+    elif loading and not tree:
+        state = 'loading'
+    else:
+        state = 'ready'
+    if state != 'ready':
+        response.status = 503
+        response.set_header('Retry-After', str(args.retry_after))
+    return {'state': state,
+            'reloading': loading and bool(tree),
+            'filename': progress['filename'],
+            'bytes_read': progress['bytes_read'],
+            'bytes_total': progress['bytes_total'],
+            'percent': loading_percent(),
+            'seconds': (progress['end'] or time.time()) - progress['start'],
+            'error': progress['error'],
+            'branches': len(tree),
+            }
 
 
 def read_directory_from_disk(dirname):
-    '''Read a directory from disk and return a dict with filenames and sizes'''
-    if args.verbose:
-        print('Reading %s from disk' % (dirname), file=sys.stderr)
-    global du
+    '''Read a directory from disk and return a list with filenames,
+    sizes and mtimes
+
+    Each entry is stat'ed only once, optionally spread over a pool of
+    --read_from_disk_threads threads, which pays off on high latency
+    filesystems like NFS.  Listings are kept for --read_from_disk_ttl
+    seconds, as long as neither the directory mtime nor the du tree
+    change, so repeated clicks on the same directory are free.
+    '''
+    # Snapshot, as update_du() may publish a new tree meanwhile
+    tree = du
 
-    children = du.getChildren(dirname)
+    children = tree.getChildren(dirname)
     known_children = set([child[0] for child in children])
 
     if not os.path.isdir(dirname):
         dirname = sep + dirname
-    filenames = os.listdir(dirname)
+
+    dir_mtime = os.stat(dirname).st_mtime
+    if dirname in disk_cache:
+        (cached_mtime, cached_atime, expires, directory) = disk_cache[dirname]
+        if (cached_mtime == dir_mtime and cached_atime == tree.atime
+            and time.time() < expires):
+            metrics.inc('dircloud_cache_hits_total', cache='read_from_disk')
+            return list(directory)
+    metrics.inc('dircloud_cache_misses_total', cache='read_from_disk')
+
+    # A popular directory clicked by many users at once is read only
+    # once
+    try:
+        directory = disk_flight.do((dirname, dir_mtime, tree.atime),
+                                   lambda: read_directory_listing(tree, dirname, dir_mtime, known_children),
+                                   args.coalesce_timeout)
+    except SingleFlightTimeout:
+        raise HTTPResponse('Still reading %s, try again later' % (dirname), status=503,
+                           headers={'Retry-After': str(args.retry_after)})
+    return list(directory)
+
+
+def read_directory_listing(tree, dirname, dir_mtime, known_children):
+    '''Scan a directory for read_directory_from_disk, and keep the
+    listing in disk_cache'''
+    if args.verbose:
+        print('Reading %s from disk' % (dirname), file=sys.stderr)
+
+    entries = scan_directory(dirname)
 
     ignored = []
     for ignore in args.index_ignore:
-        ignored.extend(fnmatch.filter(filenames, ignore))
+        ignored.extend(fnmatch.filter([entry[0] for entry in entries], ignore))
     ignored = set(ignored)
 
+    # All subdirectories share the same parent in the du tree, so
+    # fetch their sizes once instead of searching the parent branch
+    # for every one of them.
+    (parent, child) = tree.splitParentChild(os.path.join(dirname, '-')[len(args.document_root):])
+    du_sizes = dict([(branch[0], branch[1]) for branch in tree._children(parent)])
+
     directory = []
-    for filename in filenames:
-        if filename in ignored:
+    additions = []
+    for (filename, st) in entries:
+        if filename in ignored or st is None:
             continue
-        fullpath = os.path.join(dirname, filename)
-        size = os.path.getsize(fullpath)
-        mtime = os.path.getmtime(fullpath)
-        localtime = time.localtime(mtime)
-        mtime = time.strftime('%Y-%m-%d %H:%M', localtime)
-        dirpath = fullpath[len(args.document_root):]
-        if os.path.isdir(fullpath):
+        size = st.st_size
+        mtime = int(st.st_mtime)
+        dirpath = os.path.join(dirname, filename)[len(args.document_root):]
+        if stat.S_ISDIR(st.st_mode):
             filename += sep
             dirpath += sep
-            if du.getBranch(dirpath):
+            if filename in du_sizes:
                 # We prefer the size of the contents, not the direntry
-                size = du.getBranchSize(dirpath)
+                size = du_sizes[filename]
         directory.append([filename, size, mtime])
         if args.update_du_with_read_from_disk:
             if not filename in known_children:
-                if args.verbose:
-                    print('updating du[%s] with size %s' % (dirpath, size),
-                          file=sys.stderr)
-                du.addBranch(dirpath, [size, mtime], is_directory=False)
+                additions.append((dirpath, [size, mtime]))
+
+    if additions:
+        update_du(additions)
 
     directory.sort()
+
+    if args.read_from_disk_ttl > 0:
+        with disk_cache_lock:
+            if len(disk_cache) >= args.read_from_disk_cache_size:
+                # Forget the oldest listing
+                del disk_cache[next(iter(disk_cache))]
+            disk_cache[dirname] = (dir_mtime, tree.atime,
+                                   time.time() + args.read_from_disk_ttl,
+                                   directory)
     return directory
 
 
+def update_du(additions):
+    '''Add a list of (dirpath, values) branches read from disk to the
+    du tree.
+
+    Changes are applied to a copy of the tree, which is then published
+    in a single step, so readers never see a half updated tree.
+    '''
+    global du
+    while True:
+        # Built outside du_lock, so that it is only held to publish
+        base = du
+        tree = base.copy()
+        known = {}
+        added = set()
+        for (dirpath, values) in additions:
+            (parent, child) = tree.splitParentChild(dirpath)
+            child = child.rstrip(sep)
+            if not parent in known:
+                known[parent] = set([branch[0] for branch in tree._children(parent)])
+            if child in known[parent]:
+                # Already added by a concurrent request
+                continue
+            if args.verbose:
+                print('updating du[%s] with size %s' % (dirpath, values[0]),
+                      file=sys.stderr)
+            tree.addBranch(dirpath, values, is_directory=False, sort=False)
+            known[parent].add(child)
+            added.add(parent)
+        # Sorted once per parent, not once per child.  Only the
+        # branches added to, the others are shared with du.
+        tree.sortBranches(added)
+        with du_lock:
+            if du is base:
+                du = tree
+                return
+        # Another update or a reload was published meanwhile: apply
+        # the additions to it instead
+
+
+def scan_directory(dirname):
+    '''Return a list of (filename, stat) pairs for a disk directory.
+
+    Stat follows symlinks, as os.path.getsize() and friends do.
+    Entries that cannot be stat'ed (dangling symlinks, races with
+    deletions) get None instead of a stat result.
+    '''
+    global disk_pool
+
+    if scandir:
+        entries = list(scandir(dirname))
+        names = [entry.name for entry in entries]
+        def stat_entry(entry):
+            try:
+                return entry.stat()
+            except OSError:
+                return None
+    else:
+        names = os.listdir(dirname)
+        entries = [os.path.join(dirname, name) for name in names]
+        def stat_entry(fullpath):
+            try:
+                return os.stat(fullpath)
+            except OSError:
+                return None
+
+    if args.read_from_disk_threads > 1 and ThreadPoolExecutor and len(entries) > 1:
+        with disk_cache_lock:
+            if disk_pool is None:
+                disk_pool = ThreadPoolExecutor(max_workers=args.read_from_disk_threads)
+        stats = list(disk_pool.map(stat_entry, entries))
+    else:
+        stats = [stat_entry(entry) for entry in entries]
+
+    return list(zip(names, stats))
+
+
 def read_file_if_exists(dirpath, filename):
     if dirpath and filename:
         if os.path.isfile(os.path.join(dirpath, filename)):
@@ -661,14 +3601,39 @@ def openfile_fallback(item, pre=True):
     '''
 
     protocol = args.openfile_fallback.split(':')[0]
-    contents = []
 
     if protocol in ['http', 'https']:
         # Web browsers already know those protocols.  Just redirect
         # and let the browser do all the job, including error handling.
         url = args.openfile_fallback % (item)
         redirect(url)
-    elif protocol == 'file':
+
+    contents = fallback_cache.get(item)
+    if contents is None:
+        contents = read_fallback_record(protocol, item)
+    else:
+        contents = list(contents)
+
+    if pre:
+        out = '<pre>\n%s\n</pre>' % ('\n\n'.join(contents))
+    else:
+        out = '\n<p />\n'.join(contents)
+
+    return out
+
+
+def read_fallback_record(protocol, item):
+    '''Retrieve a leaf record from its openfile_fallback backend.
+
+    Backend connections are borrowed from a small pool shared by the
+    threads (see ConnectionPool).  Found records are kept in
+    fallback_cache; failures are not, so they are retried on the next
+    request.
+    '''
+    contents = []
+    cache = False
+
+    if protocol == 'file':
         filepath = args.openfile_fallback.replace('file://', '')
         filename =  filepath % (item)
         if os.path.isfile(filename):
@@ -676,105 +3641,262 @@ def openfile_fallback(item, pre=True):
         else:
             contents.append('Cannot open %s' % (filename))
     elif protocol == 'dict':
-        protocol_re = "(\w+)://([\w./]+)/d:(%s):*([\w:\*]+)*"
+        protocol_re = r"(\w+)://([\w./]+)/d:(%s):*([\w:\*]+)*"
         (protocol, host, what, dictionary) = re.findall(protocol_re, args.openfile_fallback)[0]
         if not dictionary:
             dictionary = '*'
-        try:
-            fallback = DicoClient()
-        except:
-            contents.append('Sorry, cannot create dict client for %s' % (args.openfile_fallback))
-        else:
+        definitions = None
+        # A failed connection is dropped from the pool (stale after a
+        # server restart, idle timeout...), so retry once
+        for attempt in range(2):
             try:
-                fallback.open(host)
+                with get_fallback_dico(host).connection() as fallback:
+                    definitions = fallback.define(dictionary, item)
+                break
             except:
-                contents.append('Sorry, cannot open dict connection at %s' % (host))
-            else:
-                definitions = fallback.define(dictionary, item)
-                if 'error' in definitions:
-                    contents.append('No results found for %s at %s' % (item, args.openfile_fallback))
-                else:
-                    contents = [definitions['definitions'][i]['desc'] for i in range(len(definitions['definitions']))]
+                pass
+        else:
+            contents.append('Sorry, cannot open dict connection at %s' % (host))
+        if definitions is None:
+            pass
+        elif 'error' in definitions:
+            contents.append('No results found for %s at %s' % (item, args.openfile_fallback))
+        else:
+            contents = [definitions['definitions'][i]['desc'] for i in range(len(definitions['definitions']))]
+            cache = True
     elif protocol == 'sqlite':
-        protocol_re = "(\w+)://([\w./]+)/d:(%s):(\w+):(\w+):(\w+)"
-        (protocol, filename, what, table, column, key) = re.findall(protocol_re, args.openfile_fallback)[0]
-        fallback = sqlite3.connect(filename)
+        (pool, sql) = get_fallback_sqlite()
         t = (item,)
-        sql = 'select %(column)s from %(table)s where %(key)s=?;' % {
-            'column': column,
-            'table': table,
-            'key': key,
-            }
-        for row in fallback.execute(sql, t):
-            contents.append(row[0])
-        if not contents:
+        with pool.connection() as fallback:
+            for row in fallback.execute(sql, t):
+                contents.append(row[0])
+        if contents:
+            cache = True
+        else:
             contents.append('No results found for %s at %s' % (item, args.openfile_fallback))
-        fallback.close()
 
-    if pre:
-        out = '<pre>\n%s\n</pre>' % ('\n\n'.join(contents))
-    else:
-        out = '\n<p />\n'.join(contents)
+    if cache:
+        fallback_cache.set(item, list(contents))
+    return contents
+
+
+def get_fallback_dico(host):
+    '''Return the pool of dict connections to host'''
+
+    def connect():
+        fallback = DicoClient()
+        fallback.open(host)
+        return fallback
+
+    with fallback_pools_lock:
+        if 'dict' not in fallback_pools:
+            fallback_pools['dict'] = ConnectionPool(connect)
+        return fallback_pools['dict']
 
-    return out
 
+def get_fallback_sqlite():
+    '''Return the pool of sqlite connections and the query to run on
+    them.
 
+    The connections are used by one thread at a time, but not always
+    the same one, hence check_same_thread.  As the query string never
+    changes, sqlite3 reuses the prepared statement from its per
+    connection statement cache.
+    '''
+    with fallback_pools_lock:
+        if 'sqlite' not in fallback_pools:
+            protocol_re = r"(\w+)://([\w./]+)/d:(%s):(\w+):(\w+):(\w+)"
+            (protocol, filename, what, table, column, key) = re.findall(protocol_re, args.openfile_fallback)[0]
+            sql = 'select %(column)s from %(table)s where %(key)s=?;' % {
+                'column': column,
+                'table': table,
+                'key': key,
+                }
+            pool = ConnectionPool(lambda: sqlite3.connect(filename, check_same_thread=False))
+            fallback_pools['sqlite'] = (pool, sql)
+        return fallback_pools['sqlite']
+
+
+def get_df():
+    '''Return the space tree, refreshing it when older than --df_ttl
+    seconds or than the du tree.
+
+    Only the very first call waits for the filesystems.  Afterwards,
+    a stale tree is refreshed in a background thread while requests
+    keep being served with the previous one.
+    '''
+    global df, df_refresh
+    if not df:
+        with df_lock:
+            if not df:
+                df = read_df_output()
+    elif df.atime < du.atime or time.time() - df.atime > args.df_ttl:
+        with df_lock:
+            if df_refresh is None or not df_refresh.is_alive():
+                df_refresh = threading.Thread(target=refresh_df)
+                df_refresh.daemon = True
+                df_refresh.start()
+    return df
+
+
+def refresh_df():
+    global df
+    df = read_df_output()
+
+
+@metrics.timed('dircloud_stage_duration_seconds', stage='read_df_output')
 def read_df_output():
     '''Calculate free and used disc space, and build a tree with tree
     branches: total size, used and available, each with filesystems as
     branches'''
 
-    cmd = 'LC_ALL=C /bin/df -k'
-
     df = Tree(mtime=time.time(), atime=time.time())
     if args.non_disk:
         # No disc statistcs make sense for arbitrary tres
         return df
 
-    metrics = {
+    space_metrics = {
         'size': 'Total space, used and free',
         'used': 'Used space',
         'available': 'Free space available',
         }
-    for metric in metrics:
+    for metric in space_metrics:
         # Fill root branches with zero values
-        df.addBranch(metric + sep, [0, metrics[metric]])
+        df.addBranch(metric + sep, [0, space_metrics[metric]])
+
+    if os.path.isfile('/proc/self/mounts'):
+        filesystems = read_statvfs_mounts()
+    else:
+        filesystems = read_df_command()
+
+    for (mounted_on, bytes) in filesystems:
+        if mounted_on == '/':
+            # Special case: the root filesystem.  We'll change its
+            # name to 'root' to be alphanumeric and follow the
+            # same rules than the others.
+            mounted_on = 'root'
+        for metric in space_metrics:
+            # We cannot use os.path.join here because mounted_on
+            # is an absolute path, and os.path.join discards all
+            # previous paths components, as documented.  We can
+            # use os.path.normpath, though, to remove double
+            # slashes and clean it up.
+            name = sep.join((metric, mounted_on))
+            name = os.path.normpath(name) + sep
+            values = [bytes[metric], space_metrics[metric]]
+            df.addBranch(name, values)
+            parent = metric + sep
+            if parent != name:
+                # Add to root branches (metrics)
+                df.sumToBranch(parent, bytes[metric])
+
+    return df
+
 
-    bytes = {}
-    out = subprocess.getoutput(cmd)
+def read_statvfs_mounts():
+    '''Return a list of (mounted_on, bytes) pairs for the mounted
+    filesystems, using statvfs over /proc/self/mounts.
+
+    Filesystems listed in --ignore_filesystems (by device or type) are
+    discarded before any system call.  Each statvfs runs in its own
+    thread and is given up after --df_timeout seconds, so a hung NFS
+    mount cannot block the server; that mount is skipped until its
+    pending call returns.
+    '''
+    mounts = {}
+    f = open('/proc/self/mounts')
+    for line in f:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        (filesystem, mounted_on, fstype) = fields[:3]
+        if filesystem in args.ignore_filesystems or fstype in args.ignore_filesystems:
+            continue
+        # Spaces and other special chars are octal escaped
+        mounted_on = re.sub(r'\\([0-7]{3})',
+                            lambda m: chr(int(m.group(1), 8)), mounted_on)
+        # Later mounts hide earlier ones on the same mount point
+        mounts[mounted_on] = filesystem
+    f.close()
+
+    results = {}
+    def statvfs(mounted_on):
+        try:
+            results[mounted_on] = os.statvfs(mounted_on)
+        except OSError:
+            results[mounted_on] = None
+
+    threads = []
+    for mounted_on in sorted(mounts):
+        if mounted_on in hung_mounts:
+            if hung_mounts[mounted_on].is_alive():
+                continue
+            del hung_mounts[mounted_on]
+        thread = threading.Thread(target=statvfs, args=(mounted_on,))
+        thread.daemon = True
+        thread.start()
+        threads.append((mounted_on, thread))
+
+    deadline = time.time() + args.df_timeout
+    filesystems = []
+    for (mounted_on, thread) in threads:
+        thread.join(max(0, deadline - time.time()))
+        if thread.is_alive():
+            if args.verbose:
+                print('statvfs(%s) timed out' % (mounted_on), file=sys.stderr)
+            hung_mounts[mounted_on] = thread
+            continue
+        st = results[mounted_on]
+        if st is None or not st.f_blocks:
+            # Unreadable or pseudo filesystems (proc, sysfs...),
+            # hidden by df as well.
+            continue
+        bytes = {
+            'size': st.f_blocks * st.f_frsize,
+            'used': (st.f_blocks - st.f_bfree) * st.f_frsize,
+            'available': st.f_bavail * st.f_frsize,
+            }
+        filesystems.append((mounted_on, bytes))
+
+    return filesystems
+
+
+def read_df_command():
+    '''Return a list of (mounted_on, bytes) pairs for the mounted
+    filesystems parsing df output, for systems without /proc'''
+
+    cmd = 'LC_ALL=C /bin/df -k'
+
+    filesystems = []
+    out = run_command(cmd)
     lines = out.split('\n')
     for line in lines:
         (filesystem, size, used, available, percent, mounted_on) = line.split(None, 5)
         if size.isdigit() and filesystem not in args.ignore_filesystems:
-            if mounted_on == '/':
-                # Special case: the root filesystem.  We'll change its
-                # name to 'root' to be alphanumeric and follow the
-                # same rules than the others.
-                mounted_on = 'root'
+            bytes = {}
             bytes['size'] = int(size) * 1024
             bytes['used'] = int(used) * 1024
             bytes['available'] = int(available) * 1024
-            for metric in metrics:
-                # We cannot use os.path.join here because mounted_on
-                # is an absolute path, and os.path.join discards all
-                # previous paths components, as documented.  We can
-                # use os.path.normpath, though, to remove double
-                # slashes and clean it up.
-                name = sep.join((metric, mounted_on))
-                name = os.path.normpath(name) + sep
-                values = [bytes[metric], metrics[metric]]
-                df.addBranch(name, values)
-                parent = metric + sep
-                if parent != name:
-                    # Add to root branches (metrics)
-                    df.sumToBranch(parent, bytes[metric])
+            filesystems.append((mounted_on, bytes))
 
-    return df
+    return filesystems
+
+
+@metrics.timed('dircloud_stage_duration_seconds', stage='make_cloud')
+def make_cloud(dirpath, directory, prefix='', strip_trailing_slash=False, suffix='',
+               static=False):
+    return ''.join(iter_cloud(dirpath, directory, prefix, strip_trailing_slash, suffix,
+                              static=static))
 
 
-def make_cloud(dirpath, directory, prefix='', strip_trailing_slash=False):
+def iter_cloud(dirpath, directory, prefix='', strip_trailing_slash=False, suffix='',
+               batch=1000, static=False):
+    '''Generate the html cloud of directory in chunks of batch
+    entries, to send them while the next ones are being rendered.
+    With static, sizes are not linked to their read from disk
+    page.'''
     if not directory:
-        return ''
+        return
 
     # Get the size range of our directory
     filesizes = [entry[1] for entry in directory]
@@ -834,8 +3956,12 @@ def make_cloud(dirpath, directory, prefix='', strip_trailing_slash=False):
             split_cloud = ''
 
     # Build html cloud
+    yield '<div id="htmltagcloud">'
     cloud = []
-    cloud.append('<div id="htmltagcloud">')
+    if static:
+        filesize_html = ' <span class="filesize">(%(filesize)s)</span>\n'
+    else:
+        filesize_html = ' <span class="filesize"><a %(style)s href="%(href)s%(read_from_disk)s%(suffix)s" title="%(read_from_disk_tip)s">(%(filesize)s)</a></span>\n'
 
     for entry in directory:
         (name, filesize, mtime) = entry
@@ -853,26 +3979,40 @@ def make_cloud(dirpath, directory, prefix='', strip_trailing_slash=False):
             cloud.append('<p />')
             cloud.append('<hr />')
             cloud.append('<p />')
-        cloud.append(' <span class="tagcloud%(fontsize)s" title="%(title)s"><a %(style)s href="%(href)s">%(name)s</a></span>\n <span class="filesize"><a %(style)s href="%(href)s%(read_from_disk)s" title="%(read_from_disk_tip)s">(%(filesize)s)</a></span>\n' %
+        cloud.append((' <span class="tagcloud%(fontsize)s" title="%(title)s"><a %(style)s href="%(href)s%(suffix)s">%(name)s</a></span>\n' + filesize_html) %
                      { 'fontsize': fontsizes[filesize],
-                       'title': mtime,
+                       'title': format_timestamp(mtime),
                        'href': minimal_url_quote(prefix + name),
                        'style': style,
                        'name': name_stripped,
+                       'suffix': suffix,
                        'read_from_disk': read_from_disk,
                        'read_from_disk_tip': args.read_from_disk_tip,
                        'filesize': human_readable(filesize).replace(' ',
                                                                     '&nbsp;')
                        })
+        if len(cloud) >= batch:
+            yield '\n' + '\n'.join(cloud)
+            cloud = []
 
     cloud.append('</div>')
+    yield '\n' + '\n'.join(cloud)
 
-    out = '\n'.join(cloud)
 
-    return out
+@metrics.timed('dircloud_stage_duration_seconds', stage='make_html_page')
+def make_html_page(dirpath='', header='', search='', body='', footer='',
+                   tree=None, static=False):
+    return ''.join(iter_html_page(dirpath, header, search, [body], footer, tree, static))
 
 
-def make_html_page(dirpath='', header='', search='', body='', footer=''):
+def iter_html_page(dirpath='', header='', search='', body=(), footer='',
+                   tree=None, static=False):
+    '''Generate an html page in chunks: everything up to the body
+    first, then the chunks of body (a list or a generator), then the
+    footer.  With static, without the search form and the links to
+    the pages that only dircloud can answer.'''
+    if tree is None:
+        tree = du
 
     href = sep
     breadcrumbs = []
@@ -886,17 +4026,20 @@ def make_html_page(dirpath='', header='', search='', body='', footer=''):
     if args.verbose:
         print('dirpath = [%s]' % (dirpath), file=sys.stderr)
     if dirpath in ('',  '/', read_from_disk):
-        directory = du.getChildren('/')
-        filesize = du.getBranchSize('/')
+        directory = tree.getChildren('/')
+        filesize = tree.getBranchSize('/')
         if dirpath in ('', read_from_disk):
             dirpath = sep
     else:
-        filesize = du.getBranchSize(dirpath.rstrip(read_from_disk))
-    breadcrumbs.append(' <span class="filesize"><a href="%(href)s" title="%(read_from_disk_tip)s">(%(filesize)s)</a></span>' %
-                       {'href': read_from_disk,
-                        'read_from_disk_tip': args.read_from_disk_tip,
-                        'filesize': human_readable(filesize),
-                        })
+        filesize = tree.getBranchSize(dirpath.rstrip(read_from_disk))
+    if static:
+        breadcrumbs.append(' <span class="filesize">(%s)</span>' % (human_readable(filesize)))
+    else:
+        breadcrumbs.append(' <span class="filesize"><a href="%(href)s" title="%(read_from_disk_tip)s">(%(filesize)s)</a></span>' %
+                           {'href': read_from_disk,
+                            'read_from_disk_tip': args.read_from_disk_tip,
+                            'filesize': human_readable(filesize),
+                            })
     breadcrumb = sep.join(breadcrumbs)
 
     head = html_head(title='Dircloud', dirpath=dirpath, breadcrumb=breadcrumb)
@@ -912,12 +4055,18 @@ def make_html_page(dirpath='', header='', search='', body='', footer=''):
         'search_tip': args.search_tip,
         'checkbox_tip': args.checkbox_tip
         })
-
-    footer += '\n <div class="stale_info">Page generated by <a href="/?dircloud=credits">dircloud</a></div>'
+    if static:
+        form = ''
+        footer += '\n <div class="stale_info">Page generated by dircloud</div>'
+    else:
+        footer += '\n <div class="stale_info">Page generated by <a href="/?dircloud=credits">dircloud</a></div>'
     footer += '\n</body>\n'
     footer += '\n</html>\n'
 
-    return '\n<p>'.join((head, form, header, body, footer))
+    yield displayable('\n<p>'.join((head, form, header, '')))
+    for chunk in body:
+        yield displayable(chunk)
+    yield displayable('\n<p>' + footer)
 
 
 def locate2html(filenames, maxresults=1000):
@@ -937,10 +4086,10 @@ def locate2html(filenames, maxresults=1000):
 
 def dico_define(q):
     try:
-        result = dico.define('*', q)
+        result = get_dico().define('*', q)
     except DicoNotConnectedError:
-        dico.open('localhost')
-        result = dico.define('*', q)
+        get_dico().open('localhost')
+        result = get_dico().define('*', q)
     if 'error' in result:
         pass
     return result
@@ -984,6 +4133,16 @@ def href_path_maybe(dirpath):
     return result
 
 
+def get_dico():
+    '''Return the dict search client of the current thread, as
+    DicoClient connections cannot be shared between threads'''
+    client = getattr(dico_local, 'client', None)
+    if client is None:
+        client = DicoClient()
+        dico_local.client = client
+    return client
+
+
 def get_dict_strategies(dico):
     strategies = []
     result = dico.show_strategies()
@@ -996,11 +4155,11 @@ def get_dict_strategies(dico):
 
 def dico_match(q, strategies=[]):
     if not strategies:
-        strategies = get_dict_strategies(dico)
+        strategies = get_dict_strategies(get_dico())
     results = []
     for strategy in strategies:
         strat = strategy[0]
-        result = dico.match('*', strat, q)
+        result = get_dico().match('*', strat, q)
         results.append([strategy, result])
     return results
 
@@ -1033,16 +4192,27 @@ def dico_match2html(results):
     return html
 
 
+version_re = re.compile('([0-9]+)')
+
+
 def version_key(value):
     '''Turn a string into a list of string and number chunks, so the
     numeric parts get sorted numerically, to allow filename
     sorting like GNU coreutils `ls -v' or Apache VersionSort
     '''
-    version_re = re.compile('([0-9]+)')
     return [int(chunk) if chunk.isdigit() else chunk \
                 for chunk in version_re.split(value)]
 
 
+def collation_key(value, version_sort=False):
+    '''Like version_key, but sorting the string chunks following the
+    locale rules, as ls does'''
+    if version_sort:
+        return [int(chunk) if chunk.isdigit() else locale.strxfrm(chunk) \
+                    for chunk in version_re.split(value)]
+    return locale.strxfrm(value)
+
+
 def thousands_separator(n):
     '''Format n with thousands separators for readability.  Mostly
     distilled from
@@ -1086,6 +4256,40 @@ def normalize_string(s, alphanum=False):
     return s
 
 
+def parse_size(value):
+    '''Parse a size like 100G or 512 (bytes) into bytes'''
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    multiplier = 1
+    if value and value[-1] in units:
+        multiplier = units[value[-1]]
+        value = value[:-1]
+    try:
+        return int(float(value) * multiplier)
+    except (ValueError, OverflowError):
+        # OverflowError for inf
+        raise ValueError('%s is not a size' % (value))
+
+
+def parse_age(value, now):
+    '''Parse an age like 30 (days), 2w, 6m, 1y or a date like
+    2020-01-31 into seconds since the epoch'''
+    units = {'d': 1, 'w': 7, 'm': 30, 'y': 365}
+    value = value.strip()
+    try:
+        return int(time.mktime(time.strptime(value, '%Y-%m-%d')))
+    except ValueError:
+        pass
+    days = 1
+    if value and value[-1].lower() in units:
+        days = units[value[-1].lower()]
+        value = value[:-1]
+    try:
+        return int(now - float(value) * days * 24 * 3600)
+    except (ValueError, OverflowError):
+        raise ValueError('%s is not an age' % (value))
+
+
 # From http://trac.edgewall.org/browser/trunk/trac/util/text.py
 # def pretty_size
 def human_readable(size, format='%.1f'):
@@ -1145,9 +4349,18 @@ def minimal_url_quote(s):
     '''
 
     s = s.replace('?', '%3F').replace('"', '%22').replace('&', '%26')
+    # Bytes of names not valid in UTF-8 (see parse_du) are sent as
+    # they were
+    s = surrogate_re.sub(lambda match: '%%%02X' % (ord(match.group()) - 0xdc00), s)
     return s
 
 
+def displayable(s):
+    '''Show the bytes of names not valid in UTF-8 as replacement
+    characters, as they cannot be sent as they are'''
+    return surrogate_re.sub(u'\ufffd', s)
+
+
 def get_css():
     return '''<style type="text/css">
 body {
@@ -1294,7 +4507,115 @@ span.filesize a { text-decoration: none; }
 '''
 
 
-if __name__ == '__main__':
+export_version = 2
+# The options that change the static pages, besides the tree
+export_options = ('logo_href', 'logo_img', 'non_disk')
+
+
+def export_site(out, depth=0, processes=0):
+    '''Render the pages of the du directories, down to depth levels
+    (0 for all of them), as out/<dirpath>/index.html files, so a plain
+    web server can serve them without dircloud.
+
+    Pages are rendered by a pool of processes, forked after loading
+    the tree.  A manifest in out keeps a signature of every page
+    (children and size of its directory), so a new export only renders
+    the directories that changed since the previous one, and removes
+    the pages of those that are gone.
+    '''
+    tree = read_du_file_maybe(args.filename)
+    # Pages are rendered again when an option they depend on changes,
+    # or when they come from an older version of the export
+    config = hashlib.md5(repr((export_version,
+                               [(name, getattr(args, name)) for name in export_options])).encode('utf-8')).hexdigest()
+    manifest_name = os.path.join(out, '.dircloud-manifest.json')
+    old_pages = {}
+    if os.path.isfile(manifest_name):
+        f = open(manifest_name)
+        manifest = json.load(f)
+        f.close()
+        if manifest.get('config') == config:
+            old_pages = manifest['pages']
+
+    pages = {}
+    todo = []
+    pending = ['/']
+    while pending:
+        dirpath = pending.pop()
+        if dirpath in pages:
+            continue
+        directory = tree.getChildren(dirpath)
+        if not directory:
+            continue
+        signature = repr((tree.getBranchSize(dirpath), directory))
+        signature = hashlib.md5(signature.encode('utf-8', name_errors)).hexdigest()
+        pages[dirpath] = signature
+        if old_pages.get(dirpath) != signature or not os.path.isfile(export_filename(out, dirpath)):
+            todo.append(dirpath)
+        level = 0 if dirpath == sep else dirpath.count(sep)
+        if not depth or level < depth:
+            for child in directory:
+                if child[0].endswith(sep) and child[0] != sep:
+                    pending.append(child[0] if dirpath == sep else dirpath + child[0])
+
+    chunks = [(out, todo[i:i + 1000]) for i in range(0, len(todo), 1000)]
+    if processes != 1 and len(chunks) > 1 and hasattr(multiprocessing, 'get_context') \
+            and 'fork' in multiprocessing.get_all_start_methods():
+        pool = multiprocessing.get_context('fork').Pool(processes or None)
+        written = sum(pool.imap_unordered(export_pages, chunks))
+        pool.close()
+        pool.join()
+    else:
+        written = sum([export_pages(chunk) for chunk in chunks])
+
+    removed = 0
+    for dirpath in old_pages:
+        if not dirpath in pages:
+            try:
+                os.remove(export_filename(out, dirpath))
+                removed += 1
+            except OSError:
+                pass
+
+    write_file_atomically(os.path.join(out, 'robots.txt'), args.robots_txt)
+    write_file_atomically(manifest_name, json.dumps({'config': config, 'pages': pages}))
+    if args.verbose:
+        print('%s pages, %s rendered, %s removed' % (len(pages), written, removed), file=sys.stderr)
+    return written
+
+
+def export_pages(task):
+    '''Render a chunk of pages, in a worker process of export_site()'''
+    (out, dirpaths) = task
+    tree = du
+    for dirpath in dirpaths:
+        page = directory_page(tree, dirpath, tree.getChildren(dirpath), static=True)
+        write_file_atomically(export_filename(out, dirpath), page)
+    return len(dirpaths)
+
+
+def export_filename(out, dirpath):
+    return os.path.join(out, dirpath.lstrip(sep), 'index.html')
+
+
+def write_file_atomically(filename, contents):
+    '''Write a file under a temporary name and rename it, so the web
+    server never sees half written files'''
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Created meanwhile by another worker
+            pass
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    f = io.open(tmpname, 'w', encoding='utf-8', errors=name_errors)
+    f.write(contents)
+    f.close()
+    os.rename(tmpname, filename)
+
+
+def make_parser():
     parser = argparse.ArgumentParser(description='Display the contents of a disk as wordcloud')
     parser.add_argument('filename',
                         nargs='+',
@@ -1322,6 +4643,29 @@ if __name__ == '__main__':
                              default=2010,
                              type=int,
                              help='port to run the embedded web server')
+    server_args.add_argument('--server',
+                             default='wsgiref',
+                             help='bottle server adapter; use threaded for a multithreaded wsgiref server, or asyncio for an event loop that does not wait for slow backends (default wsgiref)')
+    server_args.add_argument('--async_workers',
+                             default=20,
+                             type=int,
+                             help='with --server asyncio, threads for the requests that may wait for disks or backends (default 20)')
+    server_args.add_argument('--backend_timeout',
+                             default=30,
+                             type=float,
+                             help='seconds before giving up on locate, df and, with --server asyncio, any request waiting for a backend (default 30, 0 for never)')
+    server_args.add_argument('--workers',
+                             default=0,
+                             type=int,
+                             help='worker processes, for server adapters that fork them, like gunicorn (default: adapter default)')
+    server_args.add_argument('--preload',
+                             action='store_true',
+                             default=False,
+                             help='load and pack the du tree before starting the server, so forked workers share it (default False)')
+    server_args.add_argument('--retry_after',
+                             default=5,
+                             type=int,
+                             help='seconds clients are asked to wait while the du file is being loaded (default 5)')
     server_args.add_argument('--logo_href',
                              default='http://localhost',
                              help='Logo href')
@@ -1338,6 +4682,36 @@ if __name__ == '__main__':
                            action='store_true',
                            default=False,
                            help='wether we are dealing with disc data (default True)')
+    file_args.add_argument('--tree_db',
+                           default='',
+                           help='keep the du tree in this sqlite database instead of in memory; it is reused while the du file does not change, and can be shared by several processes (default: in memory)')
+    file_args.add_argument('--max_memory_depth',
+                           type=int,
+                           default=0,
+                           help='keep only this many levels of the du tree in memory, and deeper ones in an sqlite index on disk (default 0, all in memory)')
+    file_args.add_argument('--deep_index',
+                           default='',
+                           help='sqlite index file for --max_memory_depth (default dircloud-DUFILE.sqlite in the temporary directory)')
+    file_args.add_argument('--deep_cache_size',
+                           type=int,
+                           default=10000,
+                           help='deep branches kept in memory for --max_memory_depth (default 10000)')
+    file_args.add_argument('--federate',
+                           action='store_true',
+                           default=False,
+                           help='show all the du files at once, one per host: the root lists the hosts, named after the basename of their files, with their trees under them (default False)')
+    file_args.add_argument('--federate_processes',
+                           type=int,
+                           default=0,
+                           help='worker processes to parse the du files of --federate (default 0, one per CPU)')
+    file_args.add_argument('--largest',
+                           type=int,
+                           default=1000,
+                           help='entries kept for the largest entries report, ?dircloud=largest&n=100 (default 1000)')
+    file_args.add_argument('--pack_tree',
+                           action='store_true',
+                           default=False,
+                           help='keep the du tree in flat buffers; slower to navigate, but much smaller and shareable between forked workers (default False)')
 
     apache_args = parser.add_argument_group('Apache-like options (changed CamelCase to plan_old_names)')
     apache_args.add_argument('--document_root',
@@ -1381,37 +4755,202 @@ if __name__ == '__main__':
                              default='Read the contents of the disc, bypassing the cache',
                              help='Read from disk tip')
 
+    export_args = parser.add_argument_group('Static export options')
+    export_args.add_argument('--export',
+                             default='',
+                             metavar='DIR',
+                             help='instead of serving, render the du directory pages into DIR as static files, only the ones changed since the previous export')
+    export_args.add_argument('--export_depth',
+                             type=int,
+                             default=0,
+                             help='levels of directories to export (default 0, all)')
+    export_args.add_argument('--export_processes',
+                             type=int,
+                             default=0,
+                             help='processes rendering the pages (default 0, one per cpu)')
+
+    admin_args = parser.add_argument_group('Administration and profiling options')
+    admin_args.add_argument('--admin_key',
+                            default='',
+                            help='secret enabling admin requests, as admin_key query parameter or X-Dircloud-Admin-Key header (default: no admin requests)')
+    admin_args.add_argument('--tracemalloc',
+                            type=int,
+                            default=0,
+                            help='trace memory allocations with tracemalloc, keeping N frames, and list the top allocation sites after each load in /memory; slows dircloud down (default 0, off)')
+    admin_args.add_argument('--profile_every',
+                            type=int,
+                            default=0,
+                            help='profile one request out of every N; admin requests with profile=1 are always profiled (default 0, never)')
+    admin_args.add_argument('--profile_dir',
+                            default='.',
+                            help='directory to write request profiles (default .)')
+    admin_args.add_argument('--profile_format',
+                            choices=['pstats', 'collapsed'],
+                            default='pstats',
+                            help='request profiles as pstats files or collapsed caller;callee stacks (default pstats)')
+
     misc_args = parser.add_argument_group('Miscellaneous options')
     misc_args.add_argument('--ignore_filesystems',
                            action='append',
                            default=['tmpfs', 'udev'],
                            help='Ignore filesystems (default: tmpfs, udev)')
+    misc_args.add_argument('--df_ttl',
+                           type=float,
+                           default=300,
+                           help='seconds before filesystem space figures are refreshed (default 300)')
+    misc_args.add_argument('--df_timeout',
+                           type=float,
+                           default=5,
+                           help='seconds to wait for a filesystem to report its space (default 5)')
     misc_args.add_argument('--update_du_with_read_from_disk',
                            action='store_true',
                            default=False,
                            help='Cache filenames read from disk into du structure (default False)')
+    misc_args.add_argument('--read_from_disk_threads',
+                           type=int,
+                           default=0,
+                           help='threads used to stat directory entries read from disk; useful for NFS (default 0, serial)')
+    misc_args.add_argument('--read_from_disk_ttl',
+                           type=float,
+                           default=60,
+                           help='seconds to keep a directory listing read from disk, unless it changes (default 60, 0 disables)')
+    misc_args.add_argument('--read_from_disk_cache_size',
+                           type=int,
+                           default=1000,
+                           help='maximum number of directory listings kept in memory (default 1000)')
+    misc_args.add_argument('--page_cache_size',
+                           type=int,
+                           default=100,
+                           help='rendered directory pages kept with each tree (default 100)')
+    misc_args.add_argument('--warm_pages',
+                           type=int,
+                           default=20,
+                           help='most visited pages rendered in the background after each reload (default 20)')
+    misc_args.add_argument('--warm_depth',
+                           type=int,
+                           default=1,
+                           help='levels of the tree whose pages are rendered in the background after each reload, besides the most visited ones (default 1, the root and its children)')
+    misc_args.add_argument('--stream_threshold',
+                           type=int,
+                           default=5000,
+                           help='send the pages of directories with more children than this in chunks, as they are rendered; 0 to never do it (default 5000)')
+    misc_args.add_argument('--coalesce_timeout',
+                           type=float,
+                           default=60,
+                           help='seconds to wait for an identical read from disk or search already running, instead of running it again, before giving up with a 503 (default 60)')
     misc_args.add_argument('--openfile_fallback',
                            default='',
                            help='how to retrieve the final node (file://path/%%s, http://hostname/%%s, dict://host/d:%%s:database or sqlite://path/database.db/d:%%s:table:column:key)')
-    args = parser.parse_args()
+    misc_args.add_argument('--openfile_fallback_cache_size',
+                           type=int,
+                           default=1000,
+                           help='number of final node records kept in memory (default 1000, 0 disables)')
+    return parser
+
+
+def configure(argv=None):
+    '''Parse command line arguments (sys.argv if argv is None) into
+    the global args, and import the optional modules they ask for'''
+    global args, sqlite3, DicoClient, DicoNotConnectedError, tracemalloc
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    # For the worker processes that start afresh (see read_federation)
+    args.argv = list(sys.argv[1:] if argv is None else argv)
+
+    if args.federate:
+        if args.tree_db or args.max_memory_depth:
+            parser.error('--federate keeps the trees in memory, it cannot be used with --tree_db nor --max_memory_depth')
+        names = [host_name(filename) for filename in args.filename]
+        if len(set(names)) < len(names):
+            parser.error('--federate needs a different basename for every du file')
+
+    if args.server == 'asyncio' and (asyncio is None or ThreadPoolExecutor is None):
+        parser.error('--server asyncio needs Python 3')
+
+    fallback_cache.maxsize = args.openfile_fallback_cache_size
+    Tree.page_cache_size = args.page_cache_size
 
     # Import optional modules
-    if args.openfile_fallback.startswith('sqlite'):
+    if args.openfile_fallback.startswith('sqlite') or args.max_memory_depth or args.tree_db:
         import sqlite3
 
+    if args.tracemalloc:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(args.tracemalloc)
+
     if args.search_client == 'dicoclient' or args.openfile_fallback.startswith('dict'):
         try:
             from dicoclient import DicoClient, DicoNotConnectedError
-            dico = DicoClient()
+            DicoClient()
         except:
             args.search_client = 'locate'
 
+    if os.environ.get('DIRCLOUD_PROFILE', '').isdigit():
+        args.profile_every = int(os.environ['DIRCLOUD_PROFILE'])
+
     if 'DIRCLOUD_DEBUG' in os.environ:
         args.verbose = True
         args.debug = True
         args.reloader = True
     debug(args.debug)
 
+    return args
+
+
+def preload():
+    '''Load and pack the du tree before serving requests.
+
+    Called in the parent process of a pre-fork server, all the workers
+    share the pages of the same tree as long as nobody writes on
+    them.  Packing the tree avoids most writes due to reference
+    counting, and freezing the garbage collector avoids the rest.
+    '''
+    tree = read_du_file_maybe(args.filename)
+    tree.pack()
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+    return tree
+
+
+def make_app(argv):
+    '''Return the dircloud WSGI application, configured with the
+    command line arguments in argv, with the du tree already loaded.
+
+    For WSGI containers, like gunicorn --preload or uWSGI, that import
+    the application before forking their workers.  See
+    examples/apache/dircloud.wsgi.
+    '''
+    configure(argv)
+    preload()
+    return bottle.default_app()
+
+
+if __name__ == '__main__':
+    configure()
+    if args.export:
+        export_site(args.export, args.export_depth, args.export_processes)
+        sys.exit(0)
+    if args.preload:
+        preload()
+    else:
+        # Start parsing now, but do not wait for it to start serving
+        read_du_file_maybe(args.filename, wait=False)
+
+    server_options = {}
+    if args.server == 'threaded':
+        server = 'wsgiref'
+        server_options['server_class'] = ThreadingWSGIServer
+    elif args.server == 'asyncio':
+        server = AsyncioServer
+    else:
+        server = args.server
+    if args.workers:
+        server_options['workers'] = args.workers
+
     run(host = args.host,
         port = args.port,
-        reloader = args.reloader)
+        reloader = args.reloader,
+        server = server,
+        **server_options)
@@ -1,15 +1,286 @@
-from dircloud import read_du_file_maybe
+import gzip
+import io
+import json
+import socket
+import threading
+import time
+from wsgiref.util import setup_testing_defaults
+
+import bottle
+import pytest
+
+import dircloud
+from dircloud import Tree, read_du_file_maybe, update_du
+
+dircloud.configure(['tests/fixtures/du.boot'])
+
+
+def configure(monkeypatch, argv):
+    '''Configure dircloud with argv for one test only'''
+    monkeypatch.setattr(dircloud, 'args', dircloud.args)
+    monkeypatch.setattr(dircloud, 'du', dircloud.du)
+    dircloud.configure(argv)
+
+
+def wsgi_request(method, path, body=b'', environ=None):
+    '''Run a request through the dircloud application, and return its
+    status and body'''
+    environ = dict(environ or {}, REQUEST_METHOD=method, PATH_INFO=path)
+    environ['wsgi.input'] = io.BytesIO(body)
+    setup_testing_defaults(environ)
+    answer = []
+
+    def start_response(status, headers, exc_info=None):
+        answer.append(status)
+
+    body = b''.join(bottle.default_app()(environ, start_response))
+    return (answer[0], body)
 
 class TestReadDu:
 
     def test_read_du_file_maybe__key_format(self):
         # Test file generated with: du /boot
-        du = read_du_file_maybe('tests/fixtures/du.boot')
-        assert du.has_key('boot/') == True
-        assert du.has_key('/boot/') == False
+        du = read_du_file_maybe(['tests/fixtures/du.boot'])
+        assert ('boot/' in du.branches) == True
+        assert ('/boot/' in du.branches) == False
 
     def test_read_du_file_maybe__key_format_final_slash(self):
         # Test file generated with: du /boot/
-        du = read_du_file_maybe('tests/fixtures/du.boot_with_final_slash')
-        assert du.has_key('boot/') == True
-        assert du.has_key('/boot/') == False
+        du = read_du_file_maybe(['tests/fixtures/du.boot_with_final_slash'])
+        assert ('boot/' in du.branches) == True
+        assert ('/boot/' in du.branches) == False
+
+    @pytest.mark.parametrize('options', [[], ['--tree_db', 'tree.db'],
+                                         ['--max_memory_depth', '1', '--deep_index', 'deep.db']])
+    def test_read_du_file_maybe__name_not_utf8(self, monkeypatch, tmp_path, options):
+        filename = str(tmp_path / 'du')
+        with open(filename, 'wb') as f:
+            f.write(b'4\t/a/b/c\xff\n4\t/a/b/d\n12\t/a/b\n16\t/a\n')
+        options = [str(tmp_path / option) if option.endswith('.db') else option
+                   for option in options]
+        configure(monkeypatch, [filename] + options)
+        du = read_du_file_maybe([filename])
+        name = b'c\xff/'.decode('utf-8', dircloud.name_errors)
+        assert [child[0] for child in du.getChildren('a/b/')] == [name, 'd/']
+        assert du.getBranch('a/b/' + name)[1] == 4096
+        assert dict(du.iterBranches('a/'))['a/b/'][0][0] == name
+
+
+class TestTreeStorage:
+
+    def load(self, monkeypatch, options):
+        configure(monkeypatch, ['tests/fixtures/du.boot'] + options)
+        return dircloud.read_du_file('tests/fixtures/du.boot', 0)
+
+    def test_sqlite_tree__round_trip(self, monkeypatch, tmp_path):
+        memory = self.load(monkeypatch, [])
+        dbname = str(tmp_path / 'tree.db')
+        loaded = self.load(monkeypatch, ['--tree_db', dbname])
+        reopened = dircloud.SqliteTree.open(dbname, 'tests/fixtures/du.boot', 0)
+        for tree in (loaded, reopened):
+            assert isinstance(tree, dircloud.SqliteTree)
+            assert len(tree) == len(memory)
+            assert dict(tree.iterBranches()) == dict(memory.iterBranches())
+            assert tree.getBranch('boot/grub/') == memory.getBranch('boot/grub/')
+            assert tree.searchNames('locale') == ['boot/grub/locale/']
+
+    def test_deep_branches__round_trip(self, monkeypatch, tmp_path):
+        memory = self.load(monkeypatch, [])
+        tree = self.load(monkeypatch, ['--max_memory_depth', '1',
+                                       '--deep_index', str(tmp_path / 'deep.db')])
+        assert 'boot/grub/' not in tree.branches
+        assert tree.getChildren('boot/grub/') == memory.getChildren('boot/grub/')
+        assert dict(tree.iterBranches()) == dict(memory.iterBranches())
+
+
+class TestTree:
+
+    def test_copy__does_not_modify_original(self):
+        du = Tree()
+        du.addBranch('boot/grub/', [4356, ''])
+        copy = du.copy()
+        copy.addBranch('boot/vmlinuz', [100, ''], is_directory=False)
+        assert [child[0] for child in du.getChildren('boot/')] == ['grub/']
+        assert [child[0] for child in copy.getChildren('boot/')] == ['grub/', 'vmlinuz']
+
+    def test_copy__shares_unchanged_branches(self):
+        du = Tree()
+        du.addBranch('boot/grub/', [4356, ''])
+        du.addBranch('etc/passwd', [4, ''], is_directory=False)
+        copy = du.copy()
+        copy.addBranch('boot/vmlinuz', [100, ''], is_directory=False)
+        assert copy.branches['etc/'] is du.branches['etc/']
+        assert copy.branches['boot/'] is not du.branches['boot/']
+
+    def test_update_du__sorts_once_and_skips_known(self, monkeypatch):
+        original = Tree()
+        original.addBranch('boot/grub/', [4356, ''])
+        monkeypatch.setattr(dircloud, 'du', original)
+        update_du([('boot/vmlinuz', [100, '']), ('boot/config', [10, '']),
+                   ('boot/vmlinuz', [100, ''])])
+        assert [child[0] for child in dircloud.du.getChildren('boot/')] == ['config', 'grub/', 'vmlinuz']
+        assert [child[0] for child in original.getChildren('boot/')] == ['grub/']
+
+
+class TestParseDu:
+
+    def parse(self, chunks):
+        return dircloud.parse_du(dircloud.iter_records(chunks), 'du', 0)
+
+    def test_iter_records__nul_after_first_chunk(self):
+        # du -0, with no NUL in the first chunk
+        batches = list(dircloud.iter_records([b'4096\t/a/b', b'\n c\x00', b'8192\t/a\x00']))
+        assert [record for (length, records) in batches for record in records] == [b'4096\t/a/b\n c', b'8192\t/a']
+        assert sum([length for (length, records) in batches]) == 21
+
+    def test_parse_du__nul_terminated(self):
+        tree = self.parse([b'4\t/a/b\nc\x004\t/a/d\x0012\t/a\x00'])
+        assert [child[0] for child in tree.getChildren('a/')] == ['b\nc/', 'd/']
+
+    def test_parse_du__time(self):
+        tree = self.parse([b'4\t2021-12-17 15:30\t/a/b\n8\t2022-01-01 00:00\t/a\n'])
+        (name, size, mtime) = tree.getChildren('a/')[0]
+        assert (name, size) == ('b/', 4096)
+        assert mtime == dircloud.parse_timestamp('2021-12-17 15:30')
+
+    def test_parse_du__tabs_in_names(self):
+        # Without --time, even if the first name looks like a timestamp
+        tree = self.parse([b'4\t/a/2021-12-17 15:30\tb\n4\t/a/c\td\n12\t/a\n'])
+        assert [child[0] for child in tree.getChildren('a/')] == ['2021-12-17 15:30\tb/', 'c\td/']
+
+
+class TestFilters:
+
+    def test_filter_directory__min_size_sorted_by_size(self):
+        bottle.request.bind({'QUERY_STRING': 'min_size=2K&sort=size'})
+        tree = Tree()
+        for (name, size) in (('a/', 10), ('b/', 3000), ('c/', 5000), ('d/', 100)):
+            tree.addBranch('x/' + name, [size, ''])
+        filters = dircloud.request_filters()
+        assert filters == {'min_size': 2048}
+        directory = dircloud.filter_directory(tree, 'x/', tree.getChildren('x/'),
+                                              filters, dircloud.request_order())
+        assert [child[0] for child in directory] == ['c/', 'b/']
+
+    def test_request_filters__wrong_value(self):
+        bottle.request.bind({'QUERY_STRING': 'older_than=inf'})
+        with pytest.raises(bottle.HTTPResponse) as error:
+            dircloud.request_filters()
+        assert error.value.status_code == 400
+
+
+class TestIngest:
+
+    output = b'4\t/a/b\n4\t/a/c\n12\t/a\n'
+
+    def ingest(self, monkeypatch, body, environ):
+        configure(monkeypatch, ['tests/fixtures/du.boot', '--admin_key', 'k'])
+        environ = dict(environ, QUERY_STRING='admin_key=k')
+        (status, body) = wsgi_request('POST', '/ingest', body, environ)
+        assert status.startswith('200')
+        assert json.loads(body.decode('utf-8'))['branches'] == len(dircloud.du)
+        assert [child[0] for child in dircloud.du.getChildren('a/')] == ['b/', 'c/']
+
+    def test_ingest__chunked(self, monkeypatch):
+        body = b''.join([b'%x\r\n%s\r\n' % (len(chunk), chunk)
+                         for chunk in (self.output[:5], self.output[5:])]) + b'0\r\n\r\n'
+        self.ingest(monkeypatch, body, {'HTTP_TRANSFER_ENCODING': 'chunked'})
+
+    def test_ingest__gzip(self, monkeypatch):
+        body = gzip.compress(self.output)
+        self.ingest(monkeypatch, body, {'CONTENT_LENGTH': str(len(body))})
+
+
+class TestSingleFlight:
+
+    def test_do__collapses_concurrent_callers(self):
+        flight = dircloud.SingleFlight('test')
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def operation():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return len(calls)
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('key', operation)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(flight.do('key', operation)))
+                     for i in range(4)]
+        for follower in followers:
+            follower.start()
+        # Let the followers find the call in flight before it ends
+        key = dircloud.metrics._key('dircloud_coalesced_requests_total', {'operation': 'test'})
+        deadline = time.time() + 5
+        while dircloud.metrics.counters.get(key, 0) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        assert calls == [1]
+        assert results == [1] * 5
+
+
+class TestProfiled:
+
+    def test_profiled__streamed_body(self, monkeypatch, tmpdir):
+        configure(monkeypatch, ['tests/fixtures/du.boot', '--profile_every', '1',
+                                '--profile_dir', str(tmpdir)])
+        bottle.request.bind({})
+
+        def chunks():
+            yield 'a'
+            time.sleep(0.01)
+            yield 'b'
+
+        body = dircloud.profiled(chunks)()
+        assert not tmpdir.listdir()
+        assert list(body) == ['a', 'b']
+        body.close()
+        stats = dircloud.pstats.Stats(str(tmpdir.listdir()[0]))
+        assert any('time.sleep' in function[2] for function in stats.stats)
+        assert dircloud.profile_lock.acquire(False)
+        dircloud.profile_lock.release()
+
+
+@pytest.mark.skipif(dircloud.asyncio is None, reason='needs asyncio')
+class TestAsyncioServer:
+
+    def test_get(self, monkeypatch):
+        configure(monkeypatch, ['tests/fixtures/du.boot', '--server', 'asyncio'])
+        read_du_file_maybe(['tests/fixtures/du.boot'])
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        server = dircloud.AsyncioServer(host='127.0.0.1', port=port, quiet=True)
+        thread = threading.Thread(target=server.run, args=(bottle.default_app(),))
+        thread.daemon = True
+        thread.start()
+        try:
+            deadline = time.time() + 5
+            while True:
+                try:
+                    client = socket.create_connection(('127.0.0.1', port))
+                    break
+                except socket.error:
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.05)
+            client.sendall(b'GET /boot/ HTTP/1.0\r\n\r\n')
+            answer = b''
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                answer += data
+            client.close()
+        finally:
+            server.loop.call_soon_threadsafe(server.loop.stop)
+            thread.join(5)
+        assert answer.startswith(b'HTTP/1.1 200 ')
+        assert b'href="grub/"' in answer